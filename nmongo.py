@@ -30,6 +30,10 @@ import binascii
 import struct
 import random
 import hashlib
+try:
+    import threading
+except ImportError:
+    threading = None
 
 
 __version__ = '0.7.0'
@@ -137,6 +141,34 @@ except ImportError:
             return s
 
 
+try:
+    _Struct = struct.Struct
+except AttributeError:
+    # micropython has no struct.Struct
+    class _Struct:
+        def __init__(self, fmt):
+            self.format = fmt
+            self.size = struct.calcsize(fmt)
+
+        def pack(self, *args):
+            return struct.pack(self.format, *args)
+
+        def pack_into(self, buf, offset, *args):
+            struct.pack_into(self.format, buf, offset, *args)
+
+        def unpack_from(self, buf, offset=0):
+            return struct.unpack_from(self.format, buf, offset)
+
+
+_INT32 = _Struct('<i')
+_MSG_HEADER = _Struct('<iiii')     # messageLength, requestID, responseTo, opCode
+_INT64 = _Struct('<q')
+_DOUBLE = _Struct('<d')
+_ZERO4 = b'\x00' * 4
+_RECV_BUFFER_SIZE = 64 * 1024
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
 def _bytes_to_big_uint(b):
     "Convert from big endian bytes to uint."
     r = 0
@@ -219,10 +251,60 @@ class Code:
         return 'Code("%s")' % (self.source,)
 
 
+class Binary:
+    """BSON binary with its subtype.
+    Binary values are decoded as bytes, or as Binary keeping their subtype when decoded with binary_view=True.
+    data is bytes, or a read-only memoryview when decoded with binary_view=True.
+    Such a view keeps the whole reply it points into alive until it is released.
+    Use to_bytes() to keep a copy instead.
+    """
+    def __init__(self, data, subtype=0):
+        self.data = data
+        self.subtype = subtype
+
+    def to_bytes(self):
+        return bytes(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, o):
+        if isinstance(o, Binary):
+            return self.subtype == o.subtype and self.data == o.data
+        return self.data == o
+
+    def __hash__(self):
+        return hash((self.subtype, bytes(self.data)))
+
+    def __repr__(self):
+        return 'Binary(%r, %d)' % (self.to_bytes(), self.subtype)
+
+
 def to_cstring(s):
     return s.encode('utf-8') + b'\x00'
 
 
+# Field names seen on the wire. str -> cstring for encoding, bytes -> str for decoding.
+# Decoded documents share the same key objects. Cleared when it gets full.
+_KEY_CACHE_SIZE = 4096
+_cstring_cache = {}
+_key_cache = {}
+
+
+def _cache_cstring(k):
+    if len(_cstring_cache) >= _KEY_CACHE_SIZE:
+        _cstring_cache.clear()
+    v = _cstring_cache[k] = to_cstring(k)
+    return v
+
+
+def _cache_key(kb):
+    if len(_key_cache) >= _KEY_CACHE_SIZE:
+        _key_cache.clear()
+    k = _key_cache[kb] = kb.decode('utf-8')
+    return k
+
+
 def _from_int(n, ln):
     b = bytearray()
     for i in range(ln):
@@ -303,152 +385,664 @@ def to_uint(b):
     return r
 
 
-def _bson_encode_item(ename, v):
-    t = type(v)
-    if t == float:
-        b = b'\x01' + to_cstring(ename) + struct.pack('d', v)
-    elif t == str:
-        v = to_cstring(v)
-        b = b'\x02' + to_cstring(ename) + from_int32(len(v)) + v
-    elif t == dict:
-        v = _bson_encode_dict(v) + b'\x00'
-        b = b'\x03' + to_cstring(ename) + from_int32(len(v) + 4) + v
-    elif t in (list, tuple):
-        v = _bson_encode_list(v) + b'\x00'
-        b = b'\x04' + to_cstring(ename) + from_int32(len(v) + 4) + v
-    elif t in (bytes, ):
-        b = b'\x05' + to_cstring(ename) + from_int32(len(v)) + b'\x00' + v
-    elif t == ObjectId:
-        b = b'\x07' + to_cstring(ename) + v.to_bytes()
-    elif t == int:
-        if v < 0x8fffffff:
-            b = b'\x10' + to_cstring(ename) + from_int32(v)
-        else:
-            b = b'\x12' + to_cstring(ename) + from_int64(v)
-    elif t == bool:
-        v = b'\x01' if v else b'\x00'
-        b = b'\x08' + to_cstring(ename) + v
-    elif t == datetime.datetime:
-        v = from_int64(int(time.mktime(v.timetuple()) * 1000.0))
-        b = b'\x09' + to_cstring(ename) + v
-    elif v is None:
-        b = b'\x0a' + to_cstring(ename)
-    elif t == Code:
-        b = b'\x0d' + to_cstring(ename) + v.to_bytes()
-    elif t == Decimal:
-        b = b'\x13' + to_cstring(ename) + from_decimal(v)
+def _encode_double(b, ename, v):
+    b.append(0x01)
+    b += ename
+    b += _DOUBLE.pack(v)
+
+
+def _encode_string(b, ename, v):
+    v = v.encode('utf-8')
+    b.append(0x02)
+    b += ename
+    b += _INT32.pack(len(v) + 1)
+    b += v
+    b.append(0)
+
+
+def _encode_document(b, ename, v):
+    # the loop of _bson_encode_document, one call less for each level of nesting
+    b.append(0x03)
+    b += ename
+    start = len(b)
+    b += _ZERO4
+    encoders = _bson_encoders
+    cstrings = _cstring_cache
+    for k, x in v.items():
+        try:
+            ename = cstrings[k]
+        except KeyError:
+            ename = _cache_cstring(k)
+        try:
+            encode = encoders[type(x)]
+        except KeyError:
+            encode = _find_encoder(ename, x)
+        encode(b, ename, x)
+    b.append(0)
+    _INT32.pack_into(b, start, len(b) - start)
+
+
+def _encode_raw_document(b, ename, v):
+    b.append(0x03)
+    b += ename
+    b += v._mv[v._offset:v._offset+v._length]
+
+
+def _encode_array(b, ename, v):
+    b.append(0x04)
+    b += ename
+    _bson_encode_array(b, v)
+
+
+def _encode_binary(b, ename, v):
+    b.append(0x05)
+    b += ename
+    b += _INT32.pack(len(v))
+    b.append(0)
+    b += v
+
+
+def _encode_binary_subtype(b, ename, v):
+    b.append(0x05)
+    b += ename
+    b += _INT32.pack(len(v.data))
+    b.append(v.subtype)
+    b += v.data
+
+
+def _encode_object_id(b, ename, v):
+    b.append(0x07)
+    b += ename
+    b += v.to_bytes()
+
+
+def _encode_bool(b, ename, v):
+    b.append(0x08)
+    b += ename
+    b.append(1 if v else 0)
+
+
+def _datetime_ms(v):
+    "Milliseconds since epoch of datetime v, a naive one being local time"
+    if v.tzinfo is None:
+        seconds = time.mktime(v.timetuple())
     else:
-        raise TypeError("%s:%s" % (ename, str(t)))
+        seconds = v.replace(microsecond=0).timestamp()
+    return int(seconds) * 1000 + v.microsecond // 1000
 
-    return b
 
+def _encode_datetime(b, ename, v):
+    b.append(0x09)
+    b += ename
+    b += _INT64.pack(_datetime_ms(v))
 
-def _bson_encode_dict(d, first_key=None):
-    b = bytearray()
+
+def _encode_none(b, ename, v):
+    b.append(0x0a)
+    b += ename
+
+
+def _encode_code(b, ename, v):
+    b.append(0x0d)
+    b += ename
+    b += v.to_bytes()
+
+
+def _encode_int(b, ename, v):
+    if -0x80000000 <= v <= 0x7fffffff:
+        b.append(0x10)
+        b += ename
+        b += _INT32.pack(v)
+    else:
+        b.append(0x12)
+        b += ename
+        b += _INT64.pack(v)
+
+
+def _encode_decimal(b, ename, v):
+    b.append(0x13)
+    b += ename
+    b += from_decimal(v)
+
+
+def _bson_encode_item(b, ename, v):
+    "Append the element ename:v to bytearray b. ename is the name as cstring"
+    try:
+        encode = _bson_encoders[type(v)]
+    except KeyError:
+        encode = _find_encoder(ename, v)
+    encode(b, ename, v)
+
+
+def _bson_encode_document(b, d, first_key=None):
+    "Append document d to bytearray b, back-patching its length"
+    if type(d) == RawDocument:
+        b += d._mv[d._offset:d._offset+d._length]
+        return
+    start = len(b)
+    b += _ZERO4
     if first_key:
-        b += _bson_encode_item(first_key, d[first_key])
-        del d[first_key]
+        _bson_encode_item(b, to_cstring(first_key), d[first_key])
+    encoders = _bson_encoders
+    cstrings = _cstring_cache
     for k, v in d.items():
-        b += _bson_encode_item(k, v)
-    return b
+        if k != first_key:
+            try:
+                ename = cstrings[k]
+            except KeyError:
+                ename = _cache_cstring(k)
+            try:
+                encode = encoders[type(v)]
+            except KeyError:
+                encode = _find_encoder(ename, v)
+            encode(b, ename, v)
+    b.append(0)
+    _INT32.pack_into(b, start, len(b) - start)
+
+
+# b'0\x00', b'1\x00', ... array index names, extended on demand
+_ARRAY_KEYS = [to_cstring(str(i)) for i in range(1024)]
+
+
+def _array_keys(n):
+    "Index names for an array of length n"
+    if n > len(_ARRAY_KEYS):
+        _ARRAY_KEYS.extend([to_cstring(str(i)) for i in range(len(_ARRAY_KEYS), n)])
+    return _ARRAY_KEYS
+
+
+def _bson_encode_array(b, a):
+    "Append list a to bytearray b as a BSON array"
+    _array_keys(len(a))
+    start = len(b)
+    b += _ZERO4
+    encoders = _bson_encoders
+    for k, v in zip(_ARRAY_KEYS, a):
+        try:
+            encode = encoders[type(v)]
+        except KeyError:
+            encode = _find_encoder(k, v)
+        encode(b, k, v)
+    b.append(0)
+    _INT32.pack_into(b, start, len(b) - start)
 
 
-def _bson_encode_list(a):
+def bson_encode(v, first_key=None):
+    "from python data to binary"
     b = bytearray()
-    for i in range(len(a)):
-        b += _bson_encode_item(str(i), a[i])
-    return b
+    _bson_encode_document(b, v, first_key)
+    return bytes(b)
 
 
-def bson_encode(v, first_key=None):
-    "from python data to binary"
-    b = _bson_encode_dict(v, first_key) + b'\x00'
-    return from_int32(len(b) + 4) + b
+# Elements of arrays in a top-level document go to a new buffer once one grows to this size
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _bson_encode_chunks(chunks, d, first_key=None):
+    """Append top-level document d to the last of chunks, a list of bytearrays.
+    Large arrays continue in new buffers instead of growing one, so nothing is copied to join them.
+    """
+    b = chunks[-1]
+    if type(d) is RawDocument:
+        b += d._mv[d._offset:d._offset+d._length]
+        return
+    base = 0    # offset of b in the whole
+    for c in chunks[:-1]:
+        base += len(c)
+    doc_chunk, doc_pos, doc_start = b, len(b), base + len(b)
+    b += _ZERO4
+    keys = list(d.keys())
+    if first_key:
+        keys.remove(first_key)
+        keys.insert(0, first_key)
+    for k in keys:
+        v = d[k]
+        if type(v) not in (list, tuple):
+            _bson_encode_item(b, to_cstring(k), v)
+            continue
+        b.append(0x04)
+        b += to_cstring(k)
+        array_chunk, array_pos, array_start = b, len(b), base + len(b)
+        b += _ZERO4
+        for ename, e in zip(_array_keys(len(v)), v):
+            _bson_encode_item(b, ename, e)
+            if len(b) >= _CHUNK_SIZE:
+                base += len(b)
+                b = bytearray()
+                chunks.append(b)
+        b.append(0)
+        _INT32.pack_into(array_chunk, array_pos, base + len(b) - array_start)
+    b.append(0)
+    _INT32.pack_into(doc_chunk, doc_pos, base + len(b) - doc_start)
+
+
+class _DecodeOptions:
+    """How a reply is decoded.
+    document_class is dict or RawDocument.
+    binary_view returns binary values as Binary of a read-only memoryview into the reply buffer.
+    """
+    def __init__(self, document_class=dict, binary_view=False):
+        self.document_class = document_class
+        self.binary_view = binary_view
+
+
+_DEFAULT_OPTIONS = _DecodeOptions()
+_decode_options_cache = {(dict, False): _DEFAULT_OPTIONS}
+
+
+def _decode_options(document_class=dict, binary_view=False):
+    try:
+        return _decode_options_cache[(document_class, binary_view)]
+    except KeyError:
+        opts = _decode_options_cache[(document_class, binary_view)] = _DecodeOptions(document_class, binary_view)
+        return opts
+
+
+def _decode_double(b, mv, i, opts):
+    return _DOUBLE.unpack_from(b, i)[0], i + 8
+
+
+def _decode_string(b, mv, i, opts):
+    ln = _INT32.unpack_from(b, i)[0]
+    return b[i+4:i+3+ln].decode('utf-8'), i + 4 + ln
+
+
+def _decode_document(b, mv, i, opts):
+    if opts.document_class is RawDocument:
+        v = RawDocument(b, i, mv, opts)
+        return v, i + v._length
+    return _bson_decode_document(b, mv, i, opts)
+
+
+def _decode_binary(b, mv, i, opts):
+    ln = _INT32.unpack_from(b, i)[0]
+    if opts.binary_view:
+        return Binary(mv[i+5:i+5+ln], b[i+4]), i + 5 + ln
+    return bytes(mv[i+5:i+5+ln]), i + 5 + ln
+
+
+def _decode_none(b, mv, i, opts):
+    return None, i
+
+
+def _decode_object_id(b, mv, i, opts):
+    return ObjectId(bytes(mv[i:i+12])), i + 12
+
+
+def _decode_bool(b, mv, i, opts):
+    return b[i] != 0, i + 1
+
+
+if sys.implementation.name == 'micropython':
+    def _decode_datetime(b, mv, i, opts):
+        return time.localtime(_INT64.unpack_from(b, i)[0] / 1000), i + 8
+else:
+    def _decode_datetime(b, mv, i, opts):
+        return datetime.datetime.fromtimestamp(_INT64.unpack_from(b, i)[0] / 1000), i + 8
+
+
+def _decode_code(b, mv, i, opts):
+    ln = _INT32.unpack_from(b, i)[0]
+    return Code(str(mv[i+4:i+3+ln], 'utf-8')), i + 4 + ln
+
+
+def _decode_int32(b, mv, i, opts):
+    return _INT32.unpack_from(b, i)[0], i + 4
+
+
+def _decode_timestamp(b, mv, i, opts):
+    return bytes(mv[i:i+8]), i + 8
+
+
+def _decode_int64(b, mv, i, opts):
+    return _INT64.unpack_from(b, i)[0], i + 8
+
 
+def _decode_decimal(b, mv, i, opts):
+    return to_decimal(bytes(mv[i:i+16])), i + 16
 
-def _bson_decode_item(t, b):
-    if t == 0x01:       # double
-        v = struct.unpack('d', b[:8])[0]
-        rest = b[8:]
-    elif t == 0x02:     # string
-        ln = to_uint(b[:4])
-        v = b[4:4+ln-1].decode('utf-8')
-        rest = b[4+ln:]
-    elif t == 0x03:     # embedded document
-        v, rest = bson_decode(b)
-    elif t == 0x04:     # array
-        v = []
-        d, rest = bson_decode(b)
-        for i in sorted([int(k) for k in d]):
-            v.append(d[str(i)])
-    elif t == 0x06:
-        v = None
-        rest = b
+
+def _bson_decode_item(t, b, mv, i, opts=_DEFAULT_OPTIONS):
+    "Decode a value of BSON type t at offset i. Return the value and the next offset"
+    try:
+        decode = _bson_decoders[t]
+    except KeyError:
+        raise ValueError('Unknown %s:%s' % (hex(t), bytes(mv[i:i+16])))
+    return decode(b, mv, i, opts)
+
+
+def _bson_decode_document(b, mv, i, opts=_DEFAULT_OPTIONS):
+    "Decode a document at offset i. Return the dict and the offset just past it"
+    end = i + _INT32.unpack_from(b, i)[0] - 1
+    assert b[end] == 0
+    i += 4
+    d = {}
+    decoders = _bson_decoders
+    keys = _key_cache
+    while i < end:
+        t = b[i]
+        j = b.find(b'\x00', i + 1)
+        k = b[i+1:j]
+        try:
+            k = keys[k]
+        except KeyError:
+            k = _cache_key(k)
+        try:
+            decode = decoders[t]
+        except KeyError:
+            raise ValueError('Unknown %s:%s' % (hex(t), k))
+        d[k], i = decode(b, mv, j + 1, opts)
+    return d, end + 1
+
+
+def _bson_decode_array(b, mv, i, opts=_DEFAULT_OPTIONS):
+    "Decode an array at offset i into a list in wire order. Index names are skipped"
+    end = i + _INT32.unpack_from(b, i)[0] - 1
+    assert b[end] == 0
+    i += 4
+    a = []
+    decoders = _bson_decoders
+    while i < end:
+        t = b[i]
+        i = b.find(b'\x00', i + 1) + 1
+        try:
+            decode = decoders[t]
+        except KeyError:
+            raise ValueError('Unknown %s' % (hex(t), ))
+        v, i = decode(b, mv, i, opts)
+        a.append(v)
+    return a, end + 1
+
+
+def _bson_skip_item(t, b, i):
+    "Return the offset just past a value of BSON type t at offset i, without decoding it"
+    ln = _BSON_FIXED_SIZES.get(t)
+    if ln is not None:
+        return i + ln
+    elif t in (0x02, 0x0d):     # string, JavaScript
+        return i + 4 + _INT32.unpack_from(b, i)[0]
+    elif t in (0x03, 0x04):     # embedded document, array
+        return i + _INT32.unpack_from(b, i)[0]
     elif t == 0x05:     # binary
-        ln = to_uint(b[:4])
-        # assert b[4] == 0    # Generic binary subtype
-        v = b[5:5+ln]
-        rest = b[5+ln:]
-    elif t == 0x07:     # ObjectId
-        v = ObjectId(b[:12])
-        rest = b[12:]
-    elif t == 0x08:     # bool
-        v = b[0] != b'\x00'
-        rest = b[1:]
-    elif t == 0x09:     # time
-        if sys.implementation.name == 'micropython':
-            v = time.localtime(to_uint(b[:8]) / 1000)
+        return i + 5 + _INT32.unpack_from(b, i)[0]
+    elif t in _bson_decoders:   # registered with raw=True
+        return _bson_decoders[t](b, memoryview(b), i, _DEFAULT_OPTIONS)[1]
+    raise ValueError('Unknown %s' % (hex(t), ))
+
+
+def _compile_field_filter(field_filter):
+    "['a', 'b.c'] -> {b'a': None, b'b': {b'c': None}}. None means the whole value"
+    fields = {}
+    for name in field_filter:
+        d = fields
+        names = name.split('.')
+        for k in names[:-1]:
+            k = k.encode('utf-8')
+            if k in d and d[k] is None:
+                break
+            d = d.setdefault(k, {})
         else:
-            v = datetime.datetime.fromtimestamp(to_uint(b[:8]) / 1000)
-        rest = b[8:]
-    elif t == 0x0a:     # None
-        v = None
-        rest = b
-    elif t == 0x0d:     # JavaScript
-        ln = to_uint(b[:4])
-        v = Code(b[4:4+ln-1].decode('utf-8'))
-        rest = b[4+ln:]
-    elif t == 0x10:     # int32
-        v = struct.unpack('i', b[:4])[0]
-        rest = b[4:]
-    elif t == 0x11:     # timestamp
-        v = b[:8]
-        rest = b[8:]
-    elif t == 0x12:     # int64
-        v = struct.unpack('q', b[:8])[0]
-        rest = b[8:]
-    elif t == 0x13:     # decimal128
-        v = to_decimal(b[:16])
-        rest = b[16:]
-    else:
-        raise ValueError('Unknown %s:%s' % (hex(t), b))
+            d[names[-1].encode('utf-8')] = None
+    return fields
+
+
+def _bson_decode_fields(b, mv, i, fields, opts=_DEFAULT_OPTIONS):
+    "Decode only the fields of the document at offset i named in compiled fields. Others are skipped"
+    end = i + _INT32.unpack_from(b, i)[0] - 1
+    assert b[end] == 0
+    i += 4
+    d = {}
+    while i < end:
+        t = b[i]
+        j = b.find(b'\x00', i + 1)
+        k = b[i+1:j]
+        if k not in fields:
+            i = _bson_skip_item(t, b, j + 1)
+            continue
+        sub = fields[k]
+        if sub is None or t not in (0x03, 0x04):
+            v, i = _bson_decode_item(t, b, mv, j + 1, opts)
+        elif t == 0x03:     # embedded document
+            v, i = _bson_decode_fields(b, mv, j + 1, sub, opts)
+        else:               # array, filter the documents in it
+            v = []
+            i = j + 1
+            array_end = i + _INT32.unpack_from(b, i)[0] - 1
+            i += 4
+            while i < array_end:
+                t = b[i]
+                i = b.find(b'\x00', i + 1) + 1
+                if t == 0x03:
+                    e, i = _bson_decode_fields(b, mv, i, sub, opts)
+                else:
+                    e, i = _bson_decode_item(t, b, mv, i, opts)
+                v.append(e)
+            i += 1
+        d[_key_cache.get(k) or _cache_key(k)] = v
+    return d, end + 1
+
+
+def _bson_decode_row(b, mv, i, names, numeric, row):
+    """Decode the top-level fields of the document at offset i named in names ({name bytes: index})
+    into row[index]. Time values of numeric columns are milliseconds since epoch."""
+    end = i + _INT32.unpack_from(b, i)[0] - 1
+    assert b[end] == 0
+    i += 4
+    decoders = _bson_decoders
+    while i < end:
+        t = b[i]
+        j = b.find(b'\x00', i + 1)
+        n = names.get(b[i+1:j])
+        if n is None:
+            i = _bson_skip_item(t, b, j + 1)
+        elif t == 0x09 and numeric[n]:
+            row[n] = _INT64.unpack_from(b, j + 1)[0]
+            i = j + 9
+        else:
+            row[n], i = decoders[t](b, mv, j + 1, _DEFAULT_OPTIONS)
+
+
+_BSON_FIXED_SIZES = {
+    0x01: 8,    # double
+    0x06: 0,    # undefined
+    0x07: 12,   # ObjectId
+    0x08: 1,    # bool
+    0x09: 8,    # time
+    0x0a: 0,    # None
+    0x10: 4,    # int32
+    0x11: 8,    # timestamp
+    0x12: 8,    # int64
+    0x13: 16,   # decimal128
+}
+
+
+class RawDocument:
+    """BSON document kept as a view over the bytes it was received in.
+    A field is decoded when it is first accessed and the value is cached.
+    Embedded documents are RawDocument too.
+    """
+    def __init__(self, b, offset=0, mv=None, opts=None):
+        if isinstance(b, (bytearray, memoryview)):
+            b = bytes(b)
+        self._b = b
+        self._mv = memoryview(b) if mv is None else mv
+        self._opts = _decode_options(RawDocument) if opts is None else opts
+        self._offset = offset
+        self._length = _INT32.unpack_from(b, offset)[0]
+        self._index = None
+        self._values = {}
+
+    def _get_index(self):
+        "name -> (BSON type, value offset) of every field"
+        if self._index is None:
+            b = self._b
+            i = self._offset + 4
+            end = self._offset + self._length - 1
+            index = {}
+            while i < end:
+                t = b[i]
+                j = b.find(b'\x00', i + 1)
+                k = b[i+1:j]
+                index[_key_cache.get(k) or _cache_key(k)] = (t, j + 1)
+                i = _bson_skip_item(t, b, j + 1)
+            self._index = index
+        return self._index
+
+    def to_bytes(self):
+        return bytes(self._mv[self._offset:self._offset+self._length])
+
+    def _decode_fields(self, fields):
+        "Decode to dict with compiled field filter"
+        d, _ = _bson_decode_fields(self._b, self._mv, self._offset, fields, self._opts)
+        return d
+
+    def __getitem__(self, k):
+        try:
+            return self._values[k]
+        except KeyError:
+            pass
+        t, i = self._get_index()[k]
+        v, _ = _bson_decode_item(t, self._b, self._mv, i, self._opts)
+        self._values[k] = v
+        return v
+
+    def get(self, k, default=None):
+        if k in self._get_index():
+            return self[k]
+        return default
 
-    return v, rest
+    def keys(self):
+        return self._get_index().keys()
 
+    def values(self):
+        return [self[k] for k in self._get_index()]
 
-def _bson_decode_key_value(b):
-    t = b[0]
-    i = b[1:].find(b'\x00')
-    ename = b[1:i+1].decode('utf-8')
-    b = b[i+2:]
-    v, b = _bson_decode_item(t, b)
+    def items(self):
+        return [(k, self[k]) for k in self._get_index()]
 
-    return ename, v, b
+    def __contains__(self, k):
+        return k in self._get_index()
 
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def __eq__(self, o):
+        if isinstance(o, RawDocument):
+            return self.to_bytes() == o.to_bytes()
+        return dict(self.items()) == o
 
-def bson_decode(b):
-    "from binary to python data"
+    def __repr__(self):
+        return 'RawDocument(%r)' % (dict(self.items()), )
+
+
+_bson_encoders = {
+    float: _encode_double,
+    str: _encode_string,
+    dict: _encode_document,
+    RawDocument: _encode_raw_document,
+    list: _encode_array,
+    tuple: _encode_array,
+    bytes: _encode_binary,
+    bytearray: _encode_binary,
+    memoryview: _encode_binary,
+    Binary: _encode_binary_subtype,
+    ObjectId: _encode_object_id,
+    bool: _encode_bool,
+    datetime.datetime: _encode_datetime,
+    type(None): _encode_none,
+    Code: _encode_code,
+    int: _encode_int,
+    Decimal: _encode_decimal,
+}
+
+_bson_decoders = {
+    0x01: _decode_double,
+    0x02: _decode_string,
+    0x03: _decode_document,
+    0x04: _bson_decode_array,
+    0x05: _decode_binary,
+    0x06: _decode_none,     # undefined
+    0x07: _decode_object_id,
+    0x08: _decode_bool,
+    0x09: _decode_datetime,
+    0x0a: _decode_none,
+    0x0d: _decode_code,
+    0x10: _decode_int32,
+    0x11: _decode_timestamp,
+    0x12: _decode_int64,
+    0x13: _decode_decimal,
+}
+
+
+# subclasses added to _bson_encoders by _find_encoder
+_bson_subclass_encoders = set()
+
+
+def _find_encoder(ename, v):
+    "Encoder of a subclass of a registered type"
+    for t, encode in list(_bson_encoders.items()):
+        if isinstance(v, t):
+            _bson_encoders[type(v)] = encode
+            _bson_subclass_encoders.add(type(v))
+            return encode
+    raise TypeError("%s:%s" % (ename[:-1].decode('utf-8'), str(type(v))))
+
+
+def register_encoder(python_type, encoder):
+    """Encode python_type (and its subclasses) values with encoder(value).
+    encoder returns a value which can be encoded, e.g. str, bytes, int or dict.
+    """
+    def encode(b, ename, v):
+        _bson_encode_item(b, ename, encoder(v))
+    for t in _bson_subclass_encoders:
+        del _bson_encoders[t]
+    _bson_subclass_encoders.clear()
+    _bson_encoders[python_type] = encode
+
+
+def register_decoder(bson_type, decoder, raw=False):
+    """Decode BSON type bson_type (e.g. 0x05 for binary) with decoder(value).
+    decoder receives the value decoded as before and returns the new one.
+    With raw=True it is called as decoder(b, i) with the buffer and the offset of the value,
+    e.g. of the length of a binary before its subtype byte, and returns the value and the offset past it.
+    Type bytes without a built-in decoder (regex, MinKey, ...) need raw=True.
+    """
+    if raw:
+        def decode(b, mv, i, opts):
+            return decoder(b, i)
+    else:
+        try:
+            base = _bson_decoders[bson_type]
+        except KeyError:
+            raise ValueError("no decoder of type %s to wrap, register it with raw=True" % hex(bson_type))
+
+        def decode(b, mv, i, opts):
+            v, i = base(b, mv, i, opts)
+            return decoder(v), i
+    _bson_decoders[bson_type] = decode
+
+
+def bson_decode(b, document_class=dict, field_filter=None, binary_view=False):
+    """from binary to python data
+    field_filter is a list of field names ('a.b' for embedded one) to decode. Other fields are skipped.
+    binary_view returns binary values as Binary with a read-only memoryview into b.
+    """
     if not b:
         return {}, b''
-    ln = to_uint(b[:4])
-    rest = b[ln:]
-    assert b[ln-1] == 0
-    b = b[4:ln-1]
-    d = {}
-    while b:
-        k, v, b = _bson_decode_key_value(b)
-        d[k] = v
-    return d, rest
+    if isinstance(b, (bytearray, memoryview)):
+        b = bytes(b)
+    opts = _decode_options(document_class, binary_view)
+    if document_class is RawDocument:
+        d = RawDocument(b, 0, None, opts)
+        return d, b[d._length:]
+    if field_filter is not None:
+        d, i = _bson_decode_fields(b, memoryview(b), 0, _compile_field_filter(field_filter), opts)
+        return d, b[i:]
+    d, i = _bson_decode_document(b, memoryview(b), 0, opts)
+    return d, b[i:]
 
 # ------------------------------------------------------------------------------
 # MongoDB wire protocol
@@ -463,6 +1057,10 @@ OP_GET_MORE = 2005
 OP_DELETE = 2006
 OP_KILL_CURSORS = 2007
 OP_MSG_OPCODE = 2013
+OP_COMPRESSED_OPCODE = 2012
+# OP_MSG flag bits
+MORE_TO_COME = 1 << 1
+EXHAUST_ALLOWED = 1 << 16
 COMMANDS = set([
     # https://docs.mongodb.com/manual/reference/command/
     # Aggregation Commands
@@ -644,58 +1242,388 @@ def _pack_message(op_code, request, response, body):
     return from_int32(len(b) + 4) + b
 
 
-def _op_msg(request_id, database, metadata):
-    "Create OP_MSG packet (opcode 2013, MongoDB 3.6+)"
+# OP_COMPRESSED
+# name -> (compressorId, compress a list of buffers, decompress(data, uncompressed size))
+COMPRESSORS = {}
+
+try:
+    import zlib
+
+    def _zlib_compress(chunks):
+        c = zlib.compressobj()
+        r = [c.compress(b) for b in chunks]
+        r.append(c.flush())
+        return b''.join(r)
+
+    COMPRESSORS['zlib'] = (2, _zlib_compress, lambda data, size: zlib.decompress(data))
+except ImportError:
+    pass
+
+try:
+    from compression import zstd
+    COMPRESSORS['zstd'] = (3, lambda chunks: zstd.compress(b''.join(chunks)), lambda data, size: zstd.decompress(data))
+except ImportError:
+    try:
+        import zstandard
+        COMPRESSORS['zstd'] = (
+            3,
+            lambda chunks: zstandard.ZstdCompressor().compress(b''.join(chunks)),
+            lambda data, size: zstandard.ZstdDecompressor().decompress(data, max_output_size=size),
+        )
+    except ImportError:
+        pass
+
+_DECOMPRESSORS = {
+    0: lambda data, size: bytes(data),      # noop
+}
+for _compressor in COMPRESSORS.values():
+    _DECOMPRESSORS[_compressor[0]] = _compressor[2]
+
+# never compressed
+UNCOMPRESSED_COMMANDS = set([
+    'hello',
+    'isMaster',
+    'ismaster',
+    'saslStart',
+    'saslContinue',
+    'getnonce',
+    'authenticate',
+    'createUser',
+    'updateUser',
+    'copydbSaslStart',
+    'copydbgetnonce',
+    'copydb',
+])
+
+
+# command name -> field sent as a document sequence (section kind 1)
+DOCUMENT_SEQUENCES = {
+    'insert': 'documents',
+    'update': 'updates',
+    'delete': 'deletes',
+}
+
+
+def _chunks_len(chunks):
+    ln = 0
+    for c in chunks:
+        ln += len(c)
+    return ln
+
+
+def _command_name(metadata):
     command_name = set(metadata.keys()) & COMMANDS
     if 'findAndModify' in command_name:
-        command_name = 'findAndModify'
+        return 'findAndModify'
     elif len(command_name) == 1:
-        command_name = command_name.pop()
-    else:
-        command_name = next(iter(metadata))
+        return command_name.pop()
+    return next(iter(metadata))
+
+
+def _op_msg(request_id, database, metadata, flags=0):
+    "Create OP_MSG packet (opcode 2013, MongoDB 3.6+) as a list of buffers"
+    command_name = _command_name(metadata)
     doc = dict(metadata)
     doc['$db'] = database
-    flag_bits = b'\x00\x00\x00\x00'
-    section = b'\x00' + bson_encode(doc, command_name)
-    body = flag_bits + section
-    return _pack_message(OP_MSG_OPCODE, request_id, 0, body)
+    identifier = DOCUMENT_SEQUENCES.get(command_name)
+    sequence = None
+    if identifier is not None and type(doc.get(identifier)) in (list, tuple, _DocumentSequence):
+        sequence = doc.pop(identifier)
+    # header, flag bits and section kind 0, the length is back-patched
+    b = bytearray(21)
+    _MSG_HEADER.pack_into(b, 0, 0, request_id, 0, OP_MSG_OPCODE)
+    _INT32.pack_into(b, 16, flags)
+    chunks = [b]
+    _bson_encode_chunks(chunks, doc, command_name)
+    if sequence is not None:
+        # section kind 1: size, identifier and the documents one after another
+        section_start = _chunks_len(chunks)
+        section_chunk, section_pos = chunks[-1], len(chunks[-1]) + 1
+        section_chunk.append(1)
+        section_chunk += _ZERO4
+        section_chunk += to_cstring(identifier)
+        if type(sequence) is _DocumentSequence:
+            chunks.extend([part for part in sequence.parts if len(part)])
+        else:
+            for d in sequence:
+                _bson_encode_chunks(chunks, d)
+                if len(chunks[-1]) >= _CHUNK_SIZE:
+                    chunks.append(bytearray())
+        _INT32.pack_into(section_chunk, section_pos, _chunks_len(chunks) - section_start - 1)
+    _INT32.pack_into(b, 0, _chunks_len(chunks))
+    return chunks
+
+
+def _op_msg_reply(data, opts=_DEFAULT_OPTIONS):
+    """Parse OP_MSG reply packet
+    Documents of kind 1 sections are put in the body as a list under their identifier.
+    """
+    end = len(data)
+    if data[0] & 1:     # checksumPresent
+        end -= 4
+    mv = memoryview(data)
+    doc = None
+    sequences = []
+    i = 4
+    while i < end:
+        section_type = data[i]
+        if section_type == 0:
+            if opts.document_class is RawDocument:
+                doc = RawDocument(data, i + 1, mv, opts)
+                i += 1 + doc._length
+            else:
+                doc, i = _bson_decode_document(data, mv, i + 1, opts)
+        elif section_type == 1:
+            section_end = i + 1 + _INT32.unpack_from(data, i + 1)[0]
+            j = data.find(b'\x00', i + 5)
+            identifier = data[i+5:j].decode('utf-8')
+            i = j + 1
+            docs = []
+            while i < section_end:
+                v, i = _decode_document(data, mv, i, opts)
+                docs.append(v)
+            sequences.append((identifier, docs))
+        else:
+            raise ValueError("Unexpected OP_MSG section type: %d" % section_type)
+    if sequences:
+        if type(doc) is RawDocument:
+            doc = dict(doc.items())
+        for identifier, docs in sequences:
+            doc[identifier] = docs
+    return doc
+
+
+class _Prefetcher:
+    """Reads the batches of a cursor ahead in a thread, up to depth of them, while the consumer works on one.
+    It does not refer to the cursor, so a cursor dropped before its end is collected and stops it.
+    When it stops or fails before the end, it kills the server cursor.
+    """
+    def __init__(self, cursor, depth):
+        self.collection = cursor.collection
+        self.batchSize = cursor.batchSize
+        self.document_class = cursor.document_class
+        self.binary_view = cursor.binary_view
+        self.connection = cursor.connection
+        self.next_id = cursor.next_id       # of the server cursor after the last batch read ahead
+        self._stopped = False
+        self._start(depth)
+
+    def _start(self, depth):
+        import queue
+        self._batches = queue.Queue()
+        self._room = threading.Semaphore(depth)
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _run(self):
+        error = None
+        try:
+            while self.next_id:
+                self._room.acquire()
+                if self._stopped:
+                    break
+                r, self.connection = self.collection._getMore(
+                    self.next_id, self.batchSize, self.document_class, self.binary_view, False, self.connection)
+                self.next_id = r['cursor']['id'] if r['ok'] else 0
+                self._batches.put(r)
+        except BaseException as e:
+            error = e
+        if self.next_id:
+            try:
+                self.collection.db._command(
+                    {'killCursors': self.collection.name, 'cursors': [self.next_id]}, connection=self.connection)
+            except Exception:
+                pass
+            self.next_id = 0
+        if error is not None:
+            self._batches.put(error)
+
+    def take(self):
+        "The next reply read ahead, or the error that stopped the reading"
+        r = self._batches.get()
+        self._room.release()
+        return r
 
+    def stop(self):
+        "Stop before the next getMore, waking the thread if it waits for room"
+        self._stopped = True
+        self._room.release()
 
-def _op_msg_reply(data):
-    "Parse OP_MSG reply packet"
-    section_type = data[4]
-    if section_type == 0:
-        doc, _ = bson_decode(data[5:])
-        return doc
-    raise ValueError("Unexpected OP_MSG section type: %d" % section_type)
+    def join(self):
+        self._worker.join()
 
 
 class MongoCursor:
-    def __init__(self, collection, first_batch, next_id, batchSize=None):
+    _prefetcher = None      # _Prefetcher reading ahead
+
+    def __init__(self, collection, first_batch, next_id, batchSize=None, document_class=dict, field_filter=None,
+                 binary_view=False, exhaust=False, connection=None, prefetch=0):
         self.collection = collection
         self.batch = first_batch
         self.next_id = next_id
         self.batchSize = batchSize
+        self.document_class = document_class
+        self.binary_view = binary_view
+        self.field_filter = field_filter    # compiled, batches are RawDocument
+        self.exhaust = exhaust
+        self.connection = connection        # getMore goes to this connection while it is open
         self.next_index = 0
+        self._interrupted = False
+        if prefetch and next_id and not exhaust:
+            self._start_prefetch(int(prefetch))
+
+    def _start_prefetch(self, depth):
+        if threading is not None:
+            self._prefetcher = _Prefetcher(self, depth)
+
+    def _prefetched_batch(self, r):
+        "Take a reply read ahead, or raise the error that stopped reading ahead. The server cursor is killed then."
+        if isinstance(r, BaseException):
+            self._prefetcher = None
+            self._set_batch({'ok': 0.0})
+            raise r
+        self._set_batch(r)
+
+    def _getMore(self):
+        if self._prefetcher is not None:
+            self._prefetched_batch(self._prefetcher.take())
+            return
+        if self.connection is not None and self.connection._exhaust_cursor is self:
+            # the server keeps sending batches without getMore
+            r = self.collection.db._receive(self.connection, self, self.document_class, self.binary_view)
+        else:
+            r, self.connection = self.collection._getMore(
+                self.next_id, self.batchSize, self.document_class, self.binary_view, self.exhaust,
+                self.connection, self)
+        self._set_batch(r)
 
-    def fetchone(self):
+    def _set_batch(self, r):
+        if r['ok']:
+            self.batch = r['cursor']['nextBatch']
+            self.next_id = r['cursor']['id']
+        else:
+            self.batch = []
+            self.next_id = 0
+        self.next_index = 0
+
+    def _needs_more(self):
+        "True if the current batch is read and the server has more"
         if self.next_index == len(self.batch):
-            r = self.collection._getMore(self.next_id, self.batchSize)
-            if r['ok']:
-                self.batch = r['cursor']['nextBatch']
-                self.next_id = r['cursor']['id']
-                self.next_index = 0
-            else:
-                self.batch = []
-                self.next_id = 0
-                self.next_index = 0
+            if self._interrupted:
+                raise OperationalError("exhaust cursor was interrupted by another command")
+            return self.next_id != 0
+        return False
+
+    def _next(self):
+        "Next document of the current batch, or None"
         if self.next_index < len(self.batch):
             v = self.batch[self.next_index]
             self.next_index += 1
+            if self.field_filter is not None:
+                v = v._decode_fields(self.field_filter)
         else:
             v = None
         return v
 
+    def fetchone(self):
+        if self._needs_more():
+            self._getMore()
+        return self._next()
+
+    def _next_batch(self):
+        "The rest of the current batch, or the next batch if it is read. Empty at the end of the cursor."
+        if self._needs_more():
+            self._getMore()
+        return self._take_batch()
+
+    def _take_batch(self):
+        "The rest of the current batch"
+        batch = self.batch[self.next_index:]
+        self.next_index = len(self.batch)
+        if self.field_filter is not None:
+            batch = [d._decode_fields(self.field_filter) for d in batch]
+        return batch
+
+    def to_columns(self, fields, dtypes={}, fill_values={}, masks=False):
+        """Read the rest of the cursor into one column per field, without building a dict per document.
+        Use find(document_class=RawDocument) to decode the first batch this way too.
+        dtypes maps a field to an array typecode ('d', 'q', 'i', ...). Those columns are array.array,
+        or numpy.ndarray if numpy can be imported, and time values are stored as milliseconds.
+        Other columns are lists.
+        A missing or null field is stored as fill_values[field], default nan for 'f' and 'd', 0 for other
+        typecodes and None for lists.
+        Return {field: column}, or ({field: column}, {field: mask}) if masks is True.
+        The masks are 1 where the document had the field.
+        """
+        columns = self._columns(fields, dtypes, fill_values, masks)
+        while True:
+            try:
+                next(columns)
+            except StopIteration as e:
+                return e.value
+            self._getMore()
+
+    def _columns(self, fields, dtypes, fill_values, masks):
+        "Generator behind to_columns, it yields when the next batch is needed and returns the columns"
+        import array
+        missing = object()
+        names = {}
+        columns = []
+        fills = []
+        numeric = []
+        for n, name in enumerate(fields):
+            names[name.encode('utf-8')] = n
+            typecode = dtypes.get(name)
+            if typecode is None:
+                columns.append([])
+                fills.append(fill_values.get(name))
+            else:
+                columns.append(array.array(typecode))
+                fills.append(fill_values.get(name, float('nan') if typecode in 'fd' else 0))
+            numeric.append(typecode is not None)
+        present = [array.array('B') for _ in fields]
+
+        # following batches are not decoded to dict
+        if self.field_filter is None:
+            self.document_class = RawDocument
+        while True:
+            for doc in self.batch[self.next_index:]:
+                row = [missing] * len(fields)
+                if isinstance(doc, RawDocument):
+                    _bson_decode_row(doc._b, doc._mv, doc._offset, names, numeric, row)
+                else:
+                    for n, name in enumerate(fields):
+                        v = doc.get(name, missing)
+                        if numeric[n] and isinstance(v, datetime.datetime):
+                            v = _datetime_ms(v)
+                        row[n] = v
+                for n, v in enumerate(row):
+                    if v is missing or v is None:
+                        columns[n].append(fills[n])
+                        present[n].append(0)
+                    else:
+                        columns[n].append(v)
+                        present[n].append(1)
+            self.next_index = len(self.batch)
+            if not self.next_id:
+                break
+            yield
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            for n in range(len(fields)):
+                if numeric[n]:
+                    columns[n] = numpy.frombuffer(columns[n], dtype=columns[n].typecode)
+                present[n] = numpy.frombuffer(present[n], dtype=numpy.bool_)
+        columns = dict(zip(fields, columns))
+        if masks:
+            return columns, dict(zip(fields, present))
+        return columns
+
     def fetchall(self):
         rs = []
         r = self.fetchone()
@@ -713,44 +1641,310 @@ class MongoCursor:
             raise StopIteration()
         return r
 
+    def close(self):
+        "Release the server cursor. The rest of an exhaust stream is read and dropped."
+        db = self.collection.db
+        if self._prefetcher is not None:
+            # it kills the server cursor as it stops
+            self._prefetcher.stop()
+            self._prefetcher.join()
+            self._prefetcher = None
+            self.next_id = 0
+        if self.connection is not None and self.connection._exhaust_cursor is self:
+            db._receive(self.connection, self, drain=True)
+        elif self.next_id:
+            db._command({'killCursors': self.collection.name, 'cursors': [self.next_id]}, connection=self.connection)
+        self.batch = []
+        self.next_index = 0
+        self.next_id = 0
+
+    def __del__(self):
+        # a cursor dropped before its end stops reading ahead
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# room for the command document and headers in a message of write batch
+_WRITE_COMMAND_OVERHEAD = 16 * 1024
+
+
+# RawDocuments of this size or more are sent from their own buffer instead of being copied
+_PASS_THROUGH_SIZE = 64 * 1024
+
+
+class _DocumentSequence:
+    "Documents of a write batch encoded for an OP_MSG document sequence, in buffers that are sent as they are"
+    def __init__(self, b=None):
+        self.parts = [bytearray() if b is None else b]
+        self.count = 0
+        self.size = 0
+
+
+def _write_batches(items, max_bson_object_size, max_message_size_bytes, max_write_batch_size):
+    """Encode items straight into the buffers of batches that the server accepts.
+    Return a list of (offset of the batch in items, _DocumentSequence).
+    """
+    batches = []
+    batch = _DocumentSequence()
+    offset = 0
+    max_size = max_message_size_bytes - _WRITE_COMMAND_OVERHEAD
+    for n, d in enumerate(items):
+        b = batch.parts[-1]
+        start = len(b)
+        raw = None
+        if type(d) is RawDocument:
+            ln = d._length
+            raw = d._mv[d._offset:d._offset+ln]
+        else:
+            _bson_encode_document(b, d)
+            ln = len(b) - start
+        if ln > max_bson_object_size:
+            raise OperationalError(
+                "document %d is %d bytes, over maxBsonObjectSize %d" % (n, ln, max_bson_object_size))
+        if batch.count and (batch.size + ln > max_size or batch.count == max_write_batch_size):
+            # the document starts the next batch
+            tail = None
+            if raw is None:
+                tail = b[start:]
+                del b[start:]
+            batches.append((offset, batch))
+            batch = _DocumentSequence(tail)
+            offset = n
+        if raw is not None:
+            if ln >= _PASS_THROUGH_SIZE:
+                batch.parts.append(raw)
+                batch.parts.append(bytearray())
+            else:
+                batch.parts[-1] += raw
+        batch.count += 1
+        batch.size += ln
+        if len(batch.parts[-1]) >= _CHUNK_SIZE:
+            batch.parts.append(bytearray())
+    batches.append((offset, batch))
+    return batches
+
+
+def _merge_write_replies(r, x, offset):
+    "Add reply x of a write batch starting at offset to reply r of the batches before"
+    r = dict(r)
+    if not x['ok']:
+        # the error of the failed batch, with what the batches before did
+        for k, v in x.items():
+            if k not in ('n', 'nModified', 'writeConcernError', 'upserted', 'writeErrors'):
+                r[k] = v
+    for k in ('n', 'nModified'):
+        if k in x:
+            r[k] = r.get(k, 0) + x[k]
+    if 'writeConcernError' in x and 'writeConcernError' not in r:
+        r['writeConcernError'] = x['writeConcernError']
+    for k in ('upserted', 'writeErrors'):
+        if k in x:
+            items = r.get(k, [])
+            for e in x[k]:
+                e = dict(e)
+                e['index'] += offset
+                items.append(e)
+            r[k] = items
+    return r
+
+
+def _reply_field(name=None):
+    "Reply handler returning a field (or the whole reply) of a successful reply"
+    def result(collection, r, connection):
+        if r['ok']:
+            return r if name is None else r[name]
+        raise OperationalError(r['errmsg'])
+    return result
+
+
+def _cursor_reply(batchSize=None, document_class=dict, field_filter=None, binary_view=False, exhaust=False,
+                  prefetch=0):
+    "Reply handler returning a MongoCursor over the first batch, pinned to the connection"
+    def result(collection, r, connection):
+        if r['ok']:
+            return collection._cursor_class(
+                collection, r['cursor']['firstBatch'],
+                r['cursor']['id'],
+                batchSize,
+                document_class,
+                field_filter,
+                binary_view,
+                exhaust,
+                connection,
+                prefetch,
+            )
+        raise OperationalError(r['errmsg'])
+    return result
+
+
+def _get_field(d, key):
+    "Value of a dotted key in document d, or None"
+    for k in key.split('.'):
+        if not isinstance(d, (dict, RawDocument)):
+            return None
+        d = d.get(k)
+    return d
+
+
+def _order_key(v):
+    return v.oid if isinstance(v, ObjectId) else v
+
+
+def _range_filters(key, boundaries):
+    """Filters of the ranges of key between boundaries.
+    The first range also has the documents where key is missing or of another type.
+    """
+    if not boundaries:
+        return [{}]
+    filters = [{key: {'$not': {'$gte': boundaries[0]}}}]
+    for lower, upper in zip(boundaries, boundaries[1:]):
+        filters.append({key: {'$gte': lower, '$lt': upper}})
+    filters.append({key: {'$gte': boundaries[-1]}})
+    return filters
+
+
+def _partition_queries(query, key, boundaries):
+    "query restricted to each range of key between boundaries"
+    return [{'$and': [query, f]} if query and f else query or f for f in _range_filters(key, boundaries)]
+
+
+def _in_threads(function, args):
+    "[function(a) for a in args], in a thread pool"
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        return [function(a) for a in args]
+    with ThreadPoolExecutor(len(args)) as executor:
+        return list(executor.map(function, args))
+
+
+def _merge_scans(open_cursor, queries, depth):
+    """Documents of the cursors open_cursor(query) for queries, each read by a thread.
+    The threads hand over batches through a queue of depth batches.
+    """
+    if threading is None:
+        for query in queries:
+            for d in open_cursor(query):
+                yield d
+        return
+    import queue
+    batches = queue.Queue(depth)
+    stop = []
+
+    def put(item):
+        while not stop:
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def scan(query):
+        cursor = None
+        try:
+            cursor = open_cursor(query)
+            while not stop:
+                batch = cursor._next_batch()
+                if batch:
+                    put(batch)
+                elif not cursor.next_id:
+                    break
+        except BaseException as e:
+            put(e)
+        finally:
+            if cursor is not None and cursor.next_id:
+                try:
+                    cursor.close()
+                except BaseException:
+                    pass
+            put(None)
+
+    threads = [threading.Thread(target=scan, args=(query, )) for query in queries]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        running = len(threads)
+        while running:
+            item = batches.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                for d in item:
+                    yield d
+    finally:
+        stop.append(True)
+
 
 class MongoCollection:
+    _cursor_class = MongoCursor
+
     def __init__(self, db, name):
         self.db = db
         self.name = name
 
-    def _getMore(self, next_id, batchSize):
+    def _run(self, params, handler, document_class=dict, binary_view=False):
+        "Run a command and return handler(collection, reply, connection)"
+        r, connection = self.db._command(params, None, document_class, binary_view)
+        return handler(self, r, connection)
+
+    def _write(self, params, identifier, items, handler):
+        "Run a write command with params[identifier] = items, split into batches within the server limits"
+        db = self.db
+        batches = _write_batches(items, db.max_bson_object_size, db.max_message_size_bytes, db.max_write_batch_size)
+        if len(batches) == 1:
+            params[identifier] = batches[0][1]
+            return self._run(params, handler)
+        return self._run_batches(params, identifier, batches, handler)
+
+    def _run_batches(self, params, identifier, batches, handler):
+        "Run a write command for each batch until one fails, and return handler(collection, merged reply, connection)"
+        r = None
+        for offset, batch in batches:
+            params[identifier] = batch
+            x, connection = self.db._command(params)
+            r = x if r is None else _merge_write_replies(r, x, offset)
+            if not x['ok'] or 'writeErrors' in x:
+                break
+        return handler(self, r, connection)
+
+    def _getMore(self, next_id, batchSize, document_class=dict, binary_view=False, exhaust=False, connection=None,
+                 cursor=None):
         params = {'collection': self.name, 'getMore': next_id}
         if batchSize is not None:
             params['batchSize'] = batchSize
-        return self.db.runCommand(params)
+        return self.db._command(params, None, document_class, binary_view, exhaust, connection, cursor)
 
-    def aggregate(self, cursor={}, pipeline=[]):
+    def aggregate(self, cursor={}, pipeline=[], document_class=dict, binary_view=False, exhaust=False, prefetch=0):
         params = {
             'aggregate': self.name,
             'cursor': cursor,
             'pipeline': pipeline,
         }
-        r = self.db.runCommand(params)
-        if r['ok']:
-            return MongoCursor(
-                self, r['cursor']['firstBatch'],
-                r['cursor']['id'],
-            )
-        raise OperationalError(r['errmsg'])
+        return self._run(
+            params,
+            _cursor_reply(cursor.get('batchSize'), document_class, None, binary_view, exhaust, prefetch),
+            document_class,
+            binary_view,
+        )
 
     def bulkWrite(self, *args, **kwargs):
         raise NotImplementedError()
 
     def count(self, query={}, fields={}):
-        r = self.db.runCommand({
+        return self._run({
             'count': self.name,
             'query': query,
             'fields': fields
-        })
-        if r['ok']:
-            return r['n']
-        raise OperationalError(r['errmsg'])
+        }, _reply_field('n'))
 
     def createIndex(self, keys, options={}):
         index = options.copy()
@@ -763,47 +1957,43 @@ class MongoCollection:
             name = '_'.join(es)
             index['name'] = name
 
-        r = self.db.runCommand({
+        return self._run({
             'createIndexes': self.name,
             'indexes': [index],
-        })
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        }, _reply_field())
 
     def dataSize(self):
-        r = self.stats()
-        if r['ok']:
-            return r['avgObjSize']
-        raise OperationalError(r['errmsg'])
+        return self._run({'collStats': self.name}, _reply_field('avgObjSize'))
 
     def deleteOne(self, query):
-        return self.remove(self, query, limit=1)
+        return self.remove(query, limit=1)
 
     def deleteMany(self, query):
-        return self.remove(self, query, limit=0)
+        return self.remove(query, limit=0)
 
     def distinct(self, key, query={}):
-        r = self.db.runCommand({
+        return self._run({
             'distinct': self.name,
             'key': key,
             'query': query,
-        })
-        if r['ok']:
-            return r['values']
-        raise OperationalError(r['errmsg'])
+        }, _reply_field('values'))
 
     def drop(self):
-        metadata = self.db.runCommand({'drop': self.name})
-        return metadata['ok'] == 1.0
+        return self._run({'drop': self.name}, lambda collection, metadata, connection: metadata['ok'] == 1.0)
 
     def dropIndex(self, idx_name):
-        return self.db.runCommand({'dropIndexes': self.name, 'index': idx_name})
+        return self._run({'dropIndexes': self.name, 'index': idx_name}, lambda collection, r, connection: r)
 
     def dropIndexes(self):
         return self.dropIndex('*')
 
-    def find(self, query={}, projection=None, batchSize=None):
+    def find(self, query={}, projection=None, batchSize=None, document_class=dict, field_filter=None,
+             binary_view=False, exhaust=False, prefetch=0):
+        """exhaust lets the server stream the following batches without a getMore for each.
+        Read an exhaust cursor to the end or close it before running other commands.
+        prefetch=True, or a number of batches, has the cursor read that many batches ahead in the background
+        while the current one is consumed. Read such a cursor to the end or close it.
+        """
         params = {
             'find': self.name,
             'filter': query,
@@ -812,14 +2002,110 @@ class MongoCollection:
             params['projection'] = projection
         if batchSize is not None:
             params['batchSize'] = batchSize
-        r = self.db.runCommand(params)
+        if field_filter is not None:
+            # decode only the requested fields of each document
+            document_class = RawDocument
+            field_filter = _compile_field_filter(field_filter)
+        return self._run(
+            params,
+            _cursor_reply(batchSize, document_class, field_filter, binary_view, exhaust, prefetch),
+            document_class,
+            binary_view,
+        )
+
+    def prepare_find(self, projection=None, batchSize=None, limit=None, document_class=dict, binary_view=False):
+        "PreparedCommand to call with a query, returning a MongoCursor"
+        params = {'find': self.name}
+        if projection is not None:
+            params['projection'] = projection
+        if batchSize is not None:
+            params['batchSize'] = batchSize
+        if limit is not None:
+            params['limit'] = limit
+        return self.db._prepared_class(
+            self.db, params, ['filter'],
+            document_class=document_class,
+            binary_view=binary_view,
+            handler=_cursor_reply(batchSize, document_class, None, binary_view),
+            collection=self,
+        )
+
+    def parallel_find(self, query={}, partitions=4, key='_id', projection=None, batchSize=None,
+                      document_class=dict, merge=True):
+        """Scan the documents matching query with a find cursor for each of partitions ranges of key,
+        read at the same time by threads on their own connections of a MongoClient. key should be indexed.
+        The range boundaries are sampled with $sample, or split evenly between the min and max of a numeric key.
+        Return an iterator over the documents, in no particular order, that keeps up to two batches per partition.
+        With merge=False return the MongoCursor of each partition.
+        """
+        sampling = self._boundaries(query, partitions, key)
+        r = None
+        while True:
+            try:
+                params = sampling.send(r)
+            except StopIteration as e:
+                queries = _partition_queries(query, key, e.value)
+                break
+            r = self.db.runCommand(params)
+
+        def open_cursor(q):
+            return self.find(q, projection, batchSize, document_class)
+        if not merge:
+            return _in_threads(open_cursor, queries)
+        return _merge_scans(open_cursor, queries, 2 * len(queries))
+
+    def _boundaries(self, query, partitions, key):
+        """Up to partitions - 1 increasing values of key that split the documents matching query evenly.
+        A generator of the commands to run, like _scram_sha256: send it their replies, it returns the values.
+        """
+        boundaries = []
+        if partitions < 2:
+            return boundaries
+        size = partitions * 32
+        r = yield {
+            'aggregate': self.name,
+            # a batch larger than the sample ends the cursor
+            'cursor': {'batchSize': size + 1},
+            'pipeline': [{'$match': query}, {'$sample': {'size': size}}, {'$project': {key: 1}}],
+        }
+        values = []
         if r['ok']:
-            return MongoCursor(
-                self, r['cursor']['firstBatch'],
-                r['cursor']['id'],
-                batchSize,
-            )
-        raise OperationalError(r['errmsg'])
+            values = [v for v in (_get_field(d, key) for d in r['cursor']['firstBatch']) if v is not None]
+        if values:
+            # the documents with a key of another type go to the first range
+            kind = type(values[0])
+            values = sorted([v for v in values if type(v) is kind], key=_order_key)
+            for n in range(1, partitions):
+                v = values[len(values) * n // partitions]
+                if not boundaries or _order_key(v) > _order_key(boundaries[-1]):
+                    boundaries.append(v)
+            return boundaries
+
+        numbers = {key: {'$gt': float('-inf'), '$lt': float('inf')}}
+        ends = []
+        for direction in (1, -1):
+            r = yield {
+                'find': self.name,
+                'filter': {'$and': [query, numbers]} if query else numbers,
+                'sort': {key: direction},
+                'projection': {key: 1},
+                'limit': 1,
+                'singleBatch': True,
+            }
+            if not (r['ok'] and r['cursor']['firstBatch']):
+                return boundaries
+            ends.append(_get_field(r['cursor']['firstBatch'][0], key))
+        lower, upper = ends
+        if lower >= upper:
+            return boundaries
+        for n in range(1, partitions):
+            if isinstance(lower, int) and isinstance(upper, int):
+                v = lower + (upper - lower) * n // partitions
+            else:
+                v = lower + (upper - lower) * n / partitions
+            if not boundaries or v > boundaries[-1]:
+                boundaries.append(v)
+        return boundaries
 
     def findAndModify(self, **params):
         bad_keys = set(params.keys()) - set([
@@ -829,10 +2115,7 @@ class MongoCollection:
         if bad_keys:
             raise ValueError('Invalid Parameter %s' % (bad_keys))
         params['findAndModify'] = self.name
-        r = self.db.runCommand(params)
-        if r['ok']:
-            return r['value']
-        raise OperationalError(r['errmsg'])
+        return self._run(params, _reply_field('value'))
 
     def findOne(self, query={}, projection=None):
         params = {
@@ -843,13 +2126,15 @@ class MongoCollection:
         }
         if projection is not None:
             params['projection'] = projection
-        r = self.db.runCommand(params)
-        if r['ok']:
-            if len(r['cursor']['firstBatch']) == 1:
-                return r['cursor']['firstBatch'][0]
-            else:
-                return None
-        raise OperationalError(r['errmsg'])
+
+        def result(collection, r, connection):
+            if r['ok']:
+                if len(r['cursor']['firstBatch']) == 1:
+                    return r['cursor']['firstBatch'][0]
+                else:
+                    return None
+            raise OperationalError(r['errmsg'])
+        return self._run(params, result)
 
     def findOneAndDelete(self, query, options={}):
         params = options.copy()
@@ -866,13 +2151,14 @@ class MongoCollection:
         return self.findAndModify(**params)
 
     def findOneAndUpdate(self, query, update, options={}):
-        return self.findAndReplace(self, query, update, options)
+        return self.findOneAndReplace(query, update, options)
 
     def getIndexes(self):
-        r = self.db.runCommand({'listIndexes': self.name})
-        if r['ok']:
-            return r['cursor']['firstBatch']
-        raise OperationalError(r['errmsg'])
+        def result(collection, r, connection):
+            if r['ok']:
+                return r['cursor']['firstBatch']
+            raise OperationalError(r['errmsg'])
+        return self._run({'listIndexes': self.name}, result)
 
     def group(self, key, reduce_function, initial, keyf=None, cond=None, finalize=None):
         if not isinstance(reduce_function, Code):
@@ -894,45 +2180,43 @@ class MongoCollection:
         if finalize is not None:
             g['finalize'] = finalize
 
-        r = self.db.runCommand({'group': g})
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self._run({'group': g}, _reply_field())
 
     def insert(self, documents):
         if not isinstance(documents, list):
             documents = [documents]
-        r = self.db.runCommand({
-            'insert': self.name,
-            'documents': documents,
-        })
-        if r['ok']:
-            return r['n']
-        raise OperationalError(r['errmsg'])
+        return self._write({'insert': self.name}, 'documents', documents, _reply_field('n'))
 
     def insertOne(self, document):
-        return self.insertMany([document])[0]
+        if '_id' not in document:
+            document['_id'] = self.db.genObjectId()
+
+        def result(collection, r, connection):
+            if r['ok']:
+                return document['_id']
+            raise OperationalError(r['errmsg'])
+        return self._write({'insert': self.name}, 'documents', [document], result)
 
     def insertMany(self, documents):
         for d in documents:
             if '_id' not in d:
                 d['_id'] = self.db.genObjectId()
-        r = self.db.runCommand({
-            'insert': self.name,
-            'documents': documents,
-        })
-        if r['ok']:
-            return [d['_id'] for d in documents]
-        raise OperationalError(r['errmsg'])
+
+        def result(collection, r, connection):
+            if r['ok']:
+                return [d['_id'] for d in documents]
+            raise OperationalError(r['errmsg'])
+        return self._write({'insert': self.name}, 'documents', documents, result)
 
     def isCapped(self):
-        r = self.db.runCommand({
+        def result(collection, r, connection):
+            if r['ok']:
+                return r['cursor']['firstBatch'][0]['options']['capped']
+            raise OperationalError(r['errmsg'])
+        return self._run({
             'listCollections': 1.0,
             'filter': {'name': self.name},
-        })
-        if r['ok']:
-            return r['cursor']['firstBatch'][0]['options']['capped']
-        raise OperationalError(r['errmsg'])
+        }, result)
 
     def mapReduce(self, map_function, reduce_function, options):
         if not isinstance(map_function, Code):
@@ -943,16 +2227,10 @@ class MongoCollection:
         params['mapReduce'] = self.name
         params['map'] = map_function
         params['reduce'] = reduce_function
-        r = self.db.runCommand(params)
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self._run(params, _reply_field())
 
     def reIndex(self):
-        r = self.db.runCommand({'reIndex': self.name})
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self._run({'reIndex': self.name}, _reply_field())
 
     def replaceOne(self, query, update, options={}):
         params = options.copy()
@@ -962,59 +2240,41 @@ class MongoCollection:
         return self.update(query, update, params)
 
     def remove(self, query, limit=0):
-        r = self.db.runCommand({
-            'delete': self.name,
-            'deletes': [{'q': query, 'limit': limit}],
-        })
-        if r['ok']:
-            return r['n']
-        raise OperationalError(r['errmsg'])
+        return self._write({'delete': self.name}, 'deletes', [{'q': query, 'limit': limit}], _reply_field('n'))
 
     def renameCollection(self, new_name):
-        r = self.db.runCommand({
+        return self._run({
             'renameCollection': '.'.join([self.db.database, self.name]),
             'dropTarget': None,
             'to': '.'.join([self.db.database, new_name])
-        })
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        }, _reply_field())
 
     def save(self, document):
         if '_id' not in document:
-            r = self.insert(document)
-        else:
-            query = {'_id': document['_id']}
-            params = document.copy()
-            del params['_id']
-            r = self.update(query, params, {'multi': True, 'upsert': True})
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+            return self.insert(document)
+        query = {'_id': document['_id']}
+        params = document.copy()
+        del params['_id']
+        return self.update(query, params, {'multi': True, 'upsert': True})
 
     def stats(self, options=None):
         params = {'collStats': self.name}
         if options is not None:
             params['options'] = options
-        return self.db.runCommand(params)
+        return self._run(params, lambda collection, r, connection: r)
 
     def storageSize(self):
-        r = self.stats()
-        if r['ok']:
-            return r['storageSize']
-        raise OperationalError(r['errmsg'])
+        return self._run({'collStats': self.name}, _reply_field('storageSize'))
 
     def totalSize(self):
-        r = self.stats()
-        if r['ok']:
-            return r['totalIndexSize'] + r['storageSize']
-        raise OperationalError(r['errmsg'])
+        def result(collection, r, connection):
+            if r['ok']:
+                return r['totalIndexSize'] + r['storageSize']
+            raise OperationalError(r['errmsg'])
+        return self._run({'collStats': self.name}, result)
 
     def totalIndexSize(self):
-        r = self.stats()
-        if r['ok']:
-            return r['totalIndexSize']
-        raise OperationalError(r['errmsg'])
+        return self._run({'collStats': self.name}, _reply_field('totalIndexSize'))
 
     def update(self, query, update, options={}):
         params = options.copy()
@@ -1024,43 +2284,709 @@ class MongoCollection:
             params['multi'] = False
         params['q'] = query
         params['u'] = update
-        r = self.db.runCommand({
-            'update': self.name,
-            'updates': [params],
-        })
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self._write({'update': self.name}, 'updates', [params], _reply_field())
 
     def updateOne(self, query, update, options={}):
         params = options.copy()
         params['upsert'] = True
         params['multi'] = True
-        r = self.update(query, update, params)
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self.update(query, update, params)
 
     def updateMany(self, query, update, options={}):
         params = options.copy()
         params['upsert'] = True
         params['multi'] = True
-        r = self.update(query, update, params)
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self.update(query, update, params)
 
     def validate(self, full=None):
-        r = self.db.runCommand({
+        return self._run({
             'validate': self.name,
             'full': full,
-        })
-        if r['ok']:
+        }, _reply_field())
+
+
+class PreparedCommand:
+    """Command whose constant fields are encoded once.
+    Call it with the values of the variable fields, positionally or by name, to run the command.
+    A variable that is not given is left out.
+    """
+    def __init__(self, db, metadata, variables, database=None, document_class=dict, binary_view=False,
+                 handler=None, collection=None):
+        self.db = db
+        self.command_name = _command_name(metadata)
+        doc = dict(metadata)
+        doc['$db'] = db.database if database is None else database
+        b = bytearray(21)
+        _MSG_HEADER.pack_into(b, 0, 0, 0, 0, OP_MSG_OPCODE)
+        _bson_encode_document(b, doc, self.command_name)
+        del b[-1]       # variable fields follow, then the terminating zero
+        self._prefix = bytes(b)
+        self._variables = [(name, to_cstring(name)) for name in variables]
+        self._opts = _decode_options(document_class, binary_view)
+        self._handler = handler
+        self._collection = collection
+
+    def __call__(self, *args, **kwargs):
+        b = self._encode(args, kwargs)
+        client = self.db.client._select(None)[0]
+        connection = client._checkout()
+        try:
+            data = connection._exchange([([b], self.command_name)])[0]
+        except BaseException:
+            connection._fail()
+            raise
+        finally:
+            client._checkin(connection)
+        return self._result(data, connection)
+
+    def _encode(self, args, kwargs):
+        "The message with the values of the variables"
+        b = bytearray(self._prefix)
+        for n, (name, ename) in enumerate(self._variables):
+            if n < len(args):
+                v = args[n]
+            elif name in kwargs:
+                v = kwargs[name]
+            else:
+                continue
+            _bson_encode_item(b, ename, v)
+        b.append(0)
+        _INT32.pack_into(b, 0, len(b))
+        _INT32.pack_into(b, 21, len(b) - 21)
+        return b
+
+    def _result(self, data, connection):
+        r = _op_msg_reply(data, self._opts)
+        if self._handler is None:
             return r
+        return self._handler(self._collection, r, connection)
+
+
+class PipelineResult:
+    "Result of a command queued on a Pipeline, set when the pipeline is executed"
+    def __init__(self):
+        self.done = False
+        self._value = None
+        self._error = None
+
+    @property
+    def value(self):
+        if not self.done:
+            raise OperationalError("pipeline is not executed yet")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class PipelineCollection(MongoCollection):
+    "Collection whose commands are queued on a Pipeline"
+    def _run(self, params, handler, document_class=dict, binary_view=False):
+        return self.db._queue(self.name, params, handler, document_class, binary_view)
+
+    def _run_batches(self, params, identifier, batches, handler):
+        # a write split into batches runs at once, after the queued commands
+        self.db.execute()
+        result = PipelineResult()
+        try:
+            result._value = MongoCollection(self.db._db, self.name)._run_batches(params, identifier, batches, handler)
+        except OperationalError as e:
+            result._error = e
+        result.done = True
+        return result
+
+
+class Pipeline:
+    """Commands queued with p.<collection>.find(...), count(...), insert(...) etc. or p.command(...)
+    are sent back to back by execute(), then the replies are read and matched by responseTo.
+    Each call returns a PipelineResult. Other commands execute the queue first and run at once.
+    """
+    def __init__(self, db):
+        self._db = db
+        self.database = db.database
+        self.max_bson_object_size = db.max_bson_object_size
+        self.max_message_size_bytes = db.max_message_size_bytes
+        self.max_write_batch_size = db.max_write_batch_size
+        self._queued = []
+
+    def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError
+        return PipelineCollection(self, name)
+
+    def _queue(self, collection_name, metadata, handler, document_class=dict, binary_view=False, database=None):
+        result = PipelineResult()
+        self._queued.append((collection_name, metadata, handler, document_class, binary_view, database, result))
+        return result
+
+    def command(self, metadata, database=None, document_class=dict, binary_view=False):
+        "Queue a command, the value of the result is the reply"
+        return self._queue(None, metadata, lambda collection, r, connection: r, document_class, binary_view, database)
+
+    def genObjectId(self):
+        return self._db.genObjectId()
+
+    def runCommand(self, metadata, database=None, document_class=dict, binary_view=False, exhaust=False):
+        self.execute()
+        return self._db.runCommand(metadata, database, document_class, binary_view, exhaust)
+
+    def execute(self):
+        queued, self._queued = self._queued, []
+        if not queued:
+            return
+        client = self._db.client._select(None)[0]
+        connection = client._checkout()
+        try:
+            replies = self._execute(connection, queued)
+        except BaseException:
+            connection._fail()
+            raise
+        finally:
+            client._checkin(connection)
+        self._deliver(queued, replies, connection)
+
+    def _deliver(self, queued, replies, connection):
+        "Set the results of the queued commands"
+        db = self._db
+        for (collection_name, metadata, handler, document_class, binary_view, database, result), r in zip(queued, replies):
+            try:
+                result._value = handler(db._collection_class(db, collection_name), r, connection)
+            except OperationalError as e:
+                result._error = e
+            result.done = True
+
+    def _execute(self, connection, queued):
+        "Send the queued commands on connection and return their replies in the same order"
+        return self._decode(connection._exchange(self._messages(queued)), queued)
+
+    def _messages(self, queued):
+        return [
+            (_op_msg(0, database or self.database, metadata), next(iter(metadata)))
+            for collection_name, metadata, handler, document_class, binary_view, database, result in queued
+        ]
+
+    def _decode(self, replies, queued):
+        return [
+            _op_msg_reply(data, _decode_options(document_class, binary_view))
+            for data, (collection_name, metadata, handler, document_class, binary_view, database, result)
+            in zip(replies, queued)
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self._queued = []
+
+
+def _scram_sha256(user, password):
+    """SCRAM-SHA-256 conversation, a generator of the commands to run on the admin database.
+    Send it the reply of each command.
+    """
+    # https://github.com/mongodb/specifications/blob/master/source/auth/auth.rst#scram-sha-256
+    printable = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/'
+    nonce = ''.join(printable[random.randrange(0, len(printable))] for i in range(32))
+    r = yield {
+        'saslStart': 1.0,
+        'mechanism': 'SCRAM-SHA-256',
+        'payload': ('n,,n=%s,r=%s' % (user, nonce)).encode('utf-8'),
+    }
+    if not r['ok']:
         raise OperationalError(r['errmsg'])
+    reply_payload = {s[0]: s[2:] for s in r['payload'].decode('utf-8').split(',')}
+    reply_payload['i'] = int(reply_payload['i'])
+    assert reply_payload['r'][:len(nonce)] == nonce
+
+    # Password is used as-is (UTF-8 encoded), no MD5 hashing
+    prep_password = password.encode('utf-8')
+    salted_pass = pbkdf2_hmac_sha256(
+        prep_password,
+        base64_decode(reply_payload['s']),
+        reply_payload['i'],
+    )
+    hmac_fn = hmac_sha256_digest
+    hash_fn = hashlib.sha256
+
+    client_key = hmac_fn(salted_pass, b"Client Key")
+    auth_msg = b"n=%s,r=%s,%s,c=biws,r=%s" % (
+        user.encode('utf-8'),
+        nonce.encode('utf-8'),r['payload'],
+        reply_payload['r'].encode('utf-8'),
+    )
+    client_sig = hmac_fn(hash_fn(client_key).digest(), auth_msg)
+    proof = base64_encode(
+        b"".join([bytes([x ^ y]) for x, y in zip(client_key, client_sig)])
+    )
+    payload = ("c=biws,r=%s,p=" % reply_payload['r']).encode('utf-8') + proof
+
+    k = hmac_fn(salted_pass, b"Server Key")
+    server_sig = base64_encode(hmac_fn(k, auth_msg)).decode('utf-8')
+
+    r = yield {
+        'saslContinue': 1.0,
+        'conversationId': r['conversationId'],
+        'payload': payload,
+    }
+    if not r['ok']:
+        raise OperationalError(r['errmsg'])
+    reply_payload = {s[0]: s[2:] for s in r['payload'].decode('utf-8').split(',')}
 
+    assert reply_payload['v'] == server_sig
+
+    if not r['done']:
+        r = yield {
+            'saslContinue': 1.0,
+            'conversationId': r['conversationId'],
+            'payload': b'',
+        }
+        if not r['ok']:
+            raise OperationalError(r['errmsg'])
+
+
+def _coalesce(frames):
+    "Buffers to send for messages given as lists of buffers, joining the small ones"
+    if len(frames) == 1:
+        return frames[0]
+    out = bytearray()
+    chunks = []
+    for frame in frames:
+        for c in frame:
+            if len(out) + len(c) > _CHUNK_SIZE:
+                if out:
+                    chunks.append(out)
+                    out = bytearray()
+                chunks.append(c)
+            else:
+                out += c
+    if out:
+        chunks.append(out)
+    return chunks
+
+
+_ssl_contexts = {}      # ssl_ca_certs: SSLContext
+_tls_sessions = {}      # (ssl_ca_certs, host, port): SSLSession of the last connection
+
+
+def _ssl_context(ssl_ca_certs):
+    """TLS client context, verifying the server certificate only if ssl_ca_certs is given.
+    It is made once for each ssl_ca_certs, connections share it and the CA file is loaded once.
+    """
+    context = _ssl_contexts.get(ssl_ca_certs)
+    if context is None:
+        import ssl
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if ssl_ca_certs:
+            context.load_verify_locations(ssl_ca_certs)
+        else:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        _ssl_contexts[ssl_ca_certs] = context
+    return context
+
+
+def _wrap_socket(sock, ssl_ca_certs, host, port):
+    "Wrap sock in TLS, resuming the session of the last connection to the server to skip a full handshake"
+    session = _tls_sessions.get((ssl_ca_certs, host, port))
+    if session is not None:
+        return _ssl_context(ssl_ca_certs).wrap_socket(sock, server_hostname=host, session=session)
+    return _ssl_context(ssl_ca_certs).wrap_socket(sock, server_hostname=host)
+
+
+def _keep_tls_session(sock, ssl_ca_certs, host, port):
+    "Keep the session of sock for the next connection to the server, once a reply has brought its ticket"
+    session = getattr(sock, 'session', None)
+    if session is not None:
+        _tls_sessions[(ssl_ca_certs, host, port)] = session
+
+
+class _Connection:
+    "Message framing and server state shared by MongoConnection and AsyncMongoConnection"
+    def __init__(self, host, port, compression_threshold=1024, socket_timeout=None):
+        self.host = host
+        self.port = port
+        self.socket_timeout = socket_timeout
+        self.compressor = None      # negotiated compressor name
+        self.compression_threshold = compression_threshold
+        self.bytes_saved_sent = 0
+        self.bytes_saved_received = 0
+        # server limits, learned in the handshake
+        self.max_bson_object_size = 16 * 1024 * 1024
+        self.max_message_size_bytes = 48000000
+        self.max_write_batch_size = 100000
+        self.closed = False
+        self.last_used = _monotonic()
+        self._more_to_come = False      # the server is streaming exhaust replies
+        self._exhaust_cursor = None
+        self._response_to = 0           # of the last reply
+        self._request_id = 0
+
+    def _stamp(self, chunks, command_name):
+        "Stamp an OP_MSG with the next request id, return the id and the buffers to send"
+        request_id = self._request_id
+        self._request_id += 1
+        _INT32.pack_into(chunks[0], 4, request_id)
+        return request_id, self._compress(chunks, command_name)
+
+    def _fail(self):
+        "Close the connection after an exception interrupted a command on it, the stream may be out of step"
+        self.close()
+
+    def _hello(self, compressors):
+        "The hello command of the handshake, offering compressors"
+        params = {'hello': 1.0}
+        compressors = [c for c in compressors if c in COMPRESSORS]
+        if compressors:
+            params['compression'] = compressors
+        return params
+
+    def _learn(self, r):
+        "Take the server limits and the compressor from the reply to hello"
+        if not r['ok']:
+            return
+        self.max_bson_object_size = r.get('maxBsonObjectSize', self.max_bson_object_size)
+        self.max_message_size_bytes = r.get('maxMessageSizeBytes', self.max_message_size_bytes)
+        self.max_write_batch_size = r.get('maxWriteBatchSize', self.max_write_batch_size)
+        for c in r.get('compression', []):
+            if c in COMPRESSORS:
+                self.compressor = c
+                break
+
+    def _compress(self, chunks, command_name):
+        "Wrap OP_MSG buffers in OP_COMPRESSED when compression is negotiated and worthwhile"
+        if self.compressor is None or command_name in UNCOMPRESSED_COMMANDS:
+            return chunks
+        ln = _chunks_len(chunks)
+        if ln < self.compression_threshold:
+            return chunks
+        compressor_id, compress, _ = COMPRESSORS[self.compressor]
+        request_id = _INT32.unpack_from(chunks[0], 4)[0]
+        body = compress([memoryview(chunks[0])[16:]] + chunks[1:])
+        saved = ln - (16 + 9 + len(body))
+        if saved <= 0:
+            return chunks
+        self.bytes_saved_sent += saved
+        return [_pack_message(
+            OP_COMPRESSED_OPCODE, request_id, 0,
+            _INT32.pack(OP_MSG_OPCODE) + _INT32.pack(ln - 16) + bytes([compressor_id]) + body,
+        )]
+
+    def _message(self, opcode, mv, start, end):
+        "OP_MSG data of the message mv[start:end] after the header, decompressed or copied"
+        # replies are copied out of the receive buffer, documents decoded from them may be kept
+        if opcode == OP_COMPRESSED_OPCODE:
+            opcode, size = _INT32.unpack_from(mv, start)[0], _INT32.unpack_from(mv, start + 4)[0]
+            data = _DECOMPRESSORS[mv[start + 8]](mv[start+9:end], size)
+            self.bytes_saved_received += size - (end - start - 9)
+        else:
+            data = bytes(mv[start:end])
+        assert opcode == OP_MSG_OPCODE, "Unexpected opcode: %d" % opcode
+        self._more_to_come = data[0] & MORE_TO_COME != 0
+        if not self._more_to_come:
+            self._exhaust_cursor = None
+        return data
+
+    def _exhausted(self):
+        "Forget the cursor of an exhaust stream about to be dropped"
+        cursor, self._exhaust_cursor = self._exhaust_cursor, None
+        if cursor is not None:
+            cursor._interrupted = True
+            cursor.next_id = 0
+
+    def _forget(self):
+        "Drop a connection inherited by a forked child, nothing is sent on the parent's stream"
+        self.closed = True
+
+
+class MongoConnection(_Connection):
+    """A socket to the server, used by one thread at a time.
+    MongoDatabase borrows one from its MongoClient for each operation.
+    """
+    def __init__(self, host, port, ssl_ca_certs, compressors=None, compression_threshold=1024,
+                 connect_timeout=None, socket_timeout=None):
+        _Connection.__init__(self, host, port, compression_threshold, socket_timeout)
+        # received bytes, self._rbuf[self._rpos:self._rend] are not read yet
+        self._rbuf = bytearray(_RECV_BUFFER_SIZE)
+        self._rpos = 0
+        self._rend = 0
+        self._sock = socket.socket()
+        if connect_timeout is not None:
+            self._sock.settimeout(connect_timeout)
+        self._sock.connect(socket.getaddrinfo(self.host, self.port, socket.AF_INET)[0][-1])
+        self._sock.settimeout(socket_timeout)
+        if hasattr(socket, 'TCP_NODELAY'):
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = _wrap_socket(self._sock, ssl_ca_certs, host, port)
+        self._handshake(compressors or [])
+        _keep_tls_session(self._sock, ssl_ca_certs, host, port)
+
+    def _send(self, chunks):
+        "Send a message given as a list of buffers, without joining them"
+        for b in chunks:
+            if sys.implementation.name == 'micropython':
+                b = memoryview(b)
+                n = 0
+                while n < len(b):
+                    n += self._sock.write(b[n:])
+            else:
+                self._sock.sendall(b)
+
+    def _send_message(self, chunks, command_name):
+        "Send an OP_MSG given as a list of buffers, stamped with the next request id, and return the id"
+        if self._more_to_come:
+            self._drain()
+        request_id, chunks = self._stamp(chunks, command_name)
+        self._send(chunks)
+        return request_id
+
+    def _exchange(self, messages):
+        """Send OP_MSGs given as (buffers, command name) back to back, in one write when they are small.
+        Return the data of their replies in the same order, matched by responseTo.
+        """
+        if self._more_to_come:
+            self._drain()
+        pending = {}
+        frames = []
+        for n, (chunks, command_name) in enumerate(messages):
+            request_id, chunks = self._stamp(chunks, command_name)
+            pending[request_id] = n
+            frames.append(chunks)
+        self._send(_coalesce(frames))
+        replies = [None] * len(messages)
+        while pending:
+            data = self._recv_msg()
+            replies[pending.pop(self._response_to)] = data
+        return replies
+
+    def _handshake(self, compressors):
+        "Learn the server limits and offer compressors in the initial hello, using the one the server picks"
+        params = self._hello(compressors)
+        r = self.runCommand(params, database='admin')
+        if not r['ok']:
+            del params['hello']
+            params['isMaster'] = 1.0
+            r = self.runCommand(params, database='admin')
+        self._learn(r)
+
+    def _recv_msg(self):
+        "Receive a reply and return OP_MSG flag bits and sections"
+        self._fill(16)
+        ln, _, self._response_to, opcode = _MSG_HEADER.unpack_from(self._rbuf, self._rpos)
+        self._fill(ln)
+        start = self._rpos + 16
+        end = self._rpos + ln
+        self._rpos = end
+        data = self._message(opcode, memoryview(self._rbuf), start, end)
+        if self._rpos == self._rend and len(self._rbuf) > _RECV_BUFFER_SIZE:
+            # do not keep a buffer grown for a large reply
+            self._rbuf = bytearray(_RECV_BUFFER_SIZE)
+            self._rpos = self._rend = 0
+        return data
+
+    def _recv_reply(self, document_class=dict, binary_view=False):
+        return _op_msg_reply(self._recv_msg(), _decode_options(document_class, binary_view))
+
+    def _drain(self):
+        "Drop the rest of an exhaust stream so that the connection can be used again"
+        self._exhausted()
+        while self._more_to_come:
+            self._recv_msg()
+
+    def _fill(self, ln):
+        "Receive until ln bytes are buffered from self._rpos, taking whatever else has arrived too"
+        buf = self._rbuf
+        if self._rpos + ln > len(buf):
+            # move the unread bytes to the front, into a larger buffer if they do not fit
+            unread = self._rend - self._rpos
+            if ln > len(buf):
+                buf = bytearray(ln)
+            buf[:unread] = self._rbuf[self._rpos:self._rend]
+            self._rbuf = buf
+            self._rpos = 0
+            self._rend = unread
+        mv = memoryview(buf)
+        while self._rend - self._rpos < ln:
+            if sys.implementation.name == 'micropython':
+                n = self._sock.readinto(mv[self._rend:])
+            else:
+                n = self._sock.recv_into(mv[self._rend:])
+            if not n:
+                raise socket.error("Can't recv packets")
+            self._rend += n
+
+    def _check(self):
+        "False if the server closed the connection or sent something unasked for"
+        if self._more_to_come:
+            return True
+        if self._rpos != self._rend:
+            return False
+        try:
+            import select
+        except ImportError:
+            return True
+        try:
+            return not select.select([self._sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def auth(self, user, password):
+        conversation = _scram_sha256(user, password)
+        r = None
+        while True:
+            try:
+                params = conversation.send(r)
+            except StopIteration:
+                return
+            r = self.runCommand(params, database='admin')
+
+    def runCommand(self, metadata, database, document_class=dict, binary_view=False, exhaust=False, cursor=None):
+        """Run a command on database.
+        With exhaust, cursor is the MongoCursor to which the batches streamed by the server belong.
+        """
+        flags = EXHAUST_ALLOWED if exhaust else 0
+        self._send_message(_op_msg(0, database, metadata, flags), next(iter(metadata)))
+        r = self._recv_reply(document_class, binary_view)
+        if self._more_to_come:
+            self._exhaust_cursor = cursor
+        return r
+
+    def close(self):
+        self.closed = True
+        self._sock.close()
+
+    def _forget(self):
+        # the socket is closed in this process only, not shut down
+        MongoConnection.close(self)
+
+
+class MultiplexedConnection(MongoConnection):
+    """A connection shared by threads, which run commands on it at the same time.
+    Requests are written under a lock and a reader thread hands each reply to the future
+    of its request, found by responseTo. Exhaust cursors fall back to getMore.
+    """
+    def __init__(self, host, port, ssl_ca_certs, compressors=None, compression_threshold=1024,
+                 connect_timeout=None, socket_timeout=None):
+        self._reader = None
+        MongoConnection.__init__(
+            self, host, port, ssl_ca_certs, compressors, compression_threshold, connect_timeout, socket_timeout)
+        # the reader waits for replies as long as it takes, callers wait up to socket_timeout
+        self._sock.settimeout(None)
+        self._write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._futures = {}      # request id: future of the reply data
+        self._error = None
+        self._reader = threading.Thread(target=self._read_replies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_replies(self):
+        try:
+            while True:
+                data = self._recv_msg()
+                with self._lock:
+                    future = self._futures.pop(self._response_to, None)
+                if future is not None:
+                    future.set_result(data)
+        except BaseException as e:
+            with self._lock:
+                self._error = e if not self.closed else OperationalError("connection is closed")
+                futures, self._futures = self._futures, {}
+            if not self.closed:
+                self.close()
+            for future in futures.values():
+                future.set_exception(self._error)
+
+    def _exchange(self, messages):
+        if self._reader is None:
+            # handshake
+            return MongoConnection._exchange(self, messages)
+        from concurrent.futures import Future, TimeoutError
+        futures = []
+        with self._write_lock:
+            frames = []
+            with self._lock:
+                if self._error is not None:
+                    raise self._error
+                for chunks, command_name in messages:
+                    request_id, chunks = self._stamp(chunks, command_name)
+                    future = self._futures[request_id] = Future()
+                    futures.append((request_id, future))
+                    frames.append(chunks)
+            try:
+                self._send(_coalesce(frames))
+            except BaseException:
+                # a message written in part leaves the stream out of step for every thread
+                self.close()
+                raise
+        try:
+            return [future.result(self.socket_timeout) for request_id, future in futures]
+        except BaseException as e:
+            # the replies that still come are dropped, the other threads go on
+            with self._lock:
+                for request_id, future in futures:
+                    self._futures.pop(request_id, None)
+            if isinstance(e, TimeoutError):
+                raise socket.timeout("timed out waiting for a reply")
+            raise
+
+    def _fail(self):
+        # a timeout or an error of one thread does not stop the others, the reader closes a broken stream
+        if self._error is not None:
+            self.close()
+
+    def _check(self):
+        return self._error is None
+
+    def runCommand(self, metadata, database, document_class=dict, binary_view=False, exhaust=False, cursor=None):
+        # replies of other threads come in between, the server is not asked to stream
+        data = self._exchange([(_op_msg(0, database, metadata), next(iter(metadata)))])[0]
+        return _op_msg_reply(data, _decode_options(document_class, binary_view))
+
+    def close(self):
+        self.closed = True
+        try:
+            # wakes the reader
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError):
+            pass
+        if self._reader is not None and self._reader is not threading.current_thread():
+            # the socket is not closed under the reader, its file descriptor could be reused
+            self._reader.join()
+        self._sock.close()
+
+
+class _NoCondition:
+    "Stands in for threading.Condition where there are no threads"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def wait(self, timeout=None):
+        raise OperationalError("no connection available")
+
+    def notify(self):
+        pass
+
+
+if hasattr(os, 'register_at_fork'):
+    import weakref
+    _clients = weakref.WeakSet()    # started afresh in a forked child
+
+    def _after_fork_in_child():
+        for client in list(_clients):
+            client._after_fork()
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+else:
+    _clients = None
+
+
+class _Client:
+    "Settings, pool bookkeeping and ObjectId generation shared by MongoClient and AsyncMongoClient"
+    _database_class = None
 
-class MongoDatabase:
     def _get_machine_id_bytes(self):
         if sys.implementation.name == 'micropython':
             name = 'micropython'
@@ -1075,25 +3001,46 @@ class MongoDatabase:
     def _get_time_bytes(self):
         return bytes(reversed(from_int32(int(time.time()))))
 
-    def __init__(self, host, database, user, password, port, ssl_ca_certs):
+    def __init__(self, host, user, password, port, ssl_ca_certs, compressors, compression_threshold,
+                 connect_timeout, socket_timeout, min_pool_size, max_pool_size, max_idle_time, wait_queue_timeout):
         self.host = host
-        self.database = database
         self.user = user
         self.password = password
         self.port = port
-        self._sock = socket.socket()
-        self._sock.connect(socket.getaddrinfo(self.host, self.port, socket.AF_INET)[0][-1])
-        import ssl
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        if ssl_ca_certs:
-            context.load_verify_locations(ssl_ca_certs)
-        else:
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-        self._sock = context.wrap_socket(self._sock, server_hostname=self.host)
-
-        self._request_id = 0
+        self.ssl_ca_certs = ssl_ca_certs
+        self.compressors = compressors
+        self.compression_threshold = compression_threshold
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max_pool_size
+        self.max_idle_time = max_idle_time
+        self.wait_queue_timeout = wait_queue_timeout
+        self.compressor = None
+        # server limits, learned by the first connection
+        self.max_bson_object_size = 16 * 1024 * 1024
+        self.max_message_size_bytes = 48000000
+        self.max_write_batch_size = 100000
+        self._learned = False
+        self._idle = []             # idle connections, the most recently used last
+        self._connections = []      # open connections, idle or in use
+        self._size = 0              # open connections and the ones being opened
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_timeouts': 0,
+            'health_check_failures': 0,
+        }
+        self._bytes_saved = [0, 0]  # by closed connections
+        self._lock = threading.Lock() if threading is not None else _NoCondition()
+        self._reset_object_id()
+        self._machine_id_bytes = self._get_machine_id_bytes()
+        if _clients is not None:
+            _clients.add(self)
 
+    def _reset_object_id(self):
         if sys.implementation.name != 'micropython':
             self._object_id_counter = random.randrange(0, 0xffffff)
             self._process_id_bytes = bytes(reversed(from_int32(os.getpid())[:2]))
@@ -1103,110 +3050,334 @@ class MongoDatabase:
             self._object_id_counter = to_uint(sha1.digest()[:3])
             self._process_id_bytes = b'\x00\x00'
 
-        if self.user:
-            self.auth(self.user, self.password)
+    def _after_fork(self):
+        """Start afresh in a forked child. The connections belong to the parent, new ones are opened when needed.
+        The locks may have been held by threads of the parent, which are gone.
+        """
+        for connection in self._connections:
+            connection._forget()
+        self._idle = []
+        self._connections = []
+        self._size = 0
+        self._stats = dict.fromkeys(self._stats, 0)
+        self._bytes_saved = [0, 0]
+        self._lock = threading.Lock()
+        self._cond = self._cond.__class__()
+        self._reset_object_id()
+
+    def _adopt(self, connection):
+        "Count a new connection, learning the server limits from the first one, with self._cond held"
+        self._stats['created'] += 1
+        self._connections.append(connection)
+        if not self._learned:
+            self._learned = True
+            self.compressor = connection.compressor
+            self.max_bson_object_size = connection.max_bson_object_size
+            self.max_message_size_bytes = connection.max_message_size_bytes
+            self.max_write_batch_size = connection.max_write_batch_size
+
+    def _retire(self, connection):
+        "Forget a closed connection, with self._cond held"
+        self._size -= 1
+        self._stats['closed'] += 1
+        if connection in self._connections:
+            self._connections.remove(connection)
+        self._bytes_saved[0] += connection.bytes_saved_sent
+        self._bytes_saved[1] += connection.bytes_saved_received
+        self._cond.notify()
+
+    def _evict(self):
+        "Close connections idle for too long, with self._cond held"
+        if self.max_idle_time is None:
+            return
+        now = _monotonic()
+        while self._idle and self._size > self.min_pool_size and now - self._idle[0].last_used > self.max_idle_time:
+            connection = self._idle.pop(0)
+            connection.close()
+            self._retire(connection)
+
+    def _pop_idle(self):
+        "Take a healthy idle connection that is not busy with an exhaust stream"
+        for i in range(len(self._idle) - 1, -1, -1):
+            connection = self._idle[i]
+            if connection._more_to_come:
+                continue
+            del self._idle[i]
+            if connection._check():
+                return connection
+            self._stats['health_check_failures'] += 1
+            connection.close()
+            self._retire(connection)
+        return None
+
+    def _take(self, connection):
+        """Take the given connection or an idle one, with self._cond held.
+        Return None if a new one is to be opened, False if it is to be waited for.
+        """
+        self._evict()
+        if connection is not None and connection.closed:
+            connection = None
+        if connection is not None:
+            if connection in self._idle:
+                self._idle.remove(connection)
+                return connection
+            return False
+        c = self._pop_idle()
+        if c is not None:
+            return c
+        if self._size < self.max_pool_size:
+            self._size += 1
+            return None
+        if self._idle:
+            # the rest of an exhaust stream is dropped when it is used
+            return self._idle.pop()
+        return False
+
+    def _wait_timeout(self, deadline):
+        "Seconds left to wait for a connection, with self._cond held"
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - _monotonic()
+            if timeout <= 0:
+                self._stats['wait_timeouts'] += 1
+                raise OperationalError("timed out waiting for a connection")
+        self._stats['waits'] += 1
+        return timeout
+
+    def _checkin(self, connection):
+        with self._cond:
+            if connection.closed:
+                self._retire(connection)
+            else:
+                connection.last_used = _monotonic()
+                self._idle.append(connection)
+                self._cond.notify()
 
-        self._machine_id_bytes = self._get_machine_id_bytes()
+    def _select(self, metadata, read_preference=None, connection=None):
+        "The pool to run metadata on and the command to send, there is one server"
+        return self, metadata
 
-    def _send(self, b):
-        n = 0
-        while (n < len(b)):
-            if sys.implementation.name == 'micropython':
-                n += self._sock.write(b[n:])
-            else:
-                n += self._sock.send(b[n:])
+    def __getitem__(self, name):
+        return self._database_class(self, name)
 
-    def _recv(self, ln):
-        r = b''
-        while len(r) < ln:
-            if sys.implementation.name == 'micropython':
-                b = self._sock.read(ln-len(r))
-            else:
-                b = self._sock.recv(ln-len(r))
-            if not b:
-                raise socket.error("Can't recv packets")
-            r += b
+    def get_database(self, name, read_preference=None):
+        return self._database_class(self, name, read_preference)
+
+    def genObjectId(self):
+        with self._lock:
+            self._object_id_counter = (self._object_id_counter + 1) & 0xffffff
+            counter = self._object_id_counter
+        return ObjectId(
+            self._get_time_bytes() +
+            self._machine_id_bytes +
+            self._process_id_bytes +
+            bytes(reversed(from_int32(counter)[:3]))
+        )
+
+    @property
+    def bytes_saved_sent(self):
+        return self._bytes_saved[0] + sum(c.bytes_saved_sent for c in self._connections)
+
+    @property
+    def bytes_saved_received(self):
+        return self._bytes_saved[1] + sum(c.bytes_saved_received for c in self._connections)
+
+    def pool_stats(self):
+        with self._cond:
+            r = dict(self._stats)
+            r['size'] = len(self._connections)
+            r['idle'] = len(self._idle)
+            r['in_use'] = len(self._connections) - len(self._idle)
+            r['min_pool_size'] = self.min_pool_size
+            r['max_pool_size'] = self.max_pool_size
         return r
 
+    def close(self):
+        "Close all connections, the ones in use are closed under their users"
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            for connection in self._connections:
+                connection.close()
+            for connection in idle:
+                self._retire(connection)
+
+
+class MongoClient(_Client):
+    """Pool of connections to a server, shared by threads.
+    MongoDatabase borrows a connection for each operation and returns it afterwards.
+    min_pool_size connections are opened at once and kept open.
+    Others are closed when they have been idle for max_idle_time seconds.
+    When max_pool_size connections are in use, borrowing waits up to wait_queue_timeout seconds (None waits forever).
+    Idle connections are checked before they are lent, and closed if the server has closed them.
+    """
+    _connection_class = MongoConnection
+
+    def __init__(self, host, user=None, password='', port=27017, ssl_ca_certs=None, compressors=None,
+                 compression_threshold=1024, connect_timeout=None, socket_timeout=None,
+                 min_pool_size=0, max_pool_size=100, max_idle_time=None, wait_queue_timeout=None):
+        _Client.__init__(
+            self, host, user, password, port, ssl_ca_certs, compressors, compression_threshold,
+            connect_timeout, socket_timeout, min_pool_size, max_pool_size, max_idle_time, wait_queue_timeout,
+        )
+        self._cond = threading.Condition() if threading is not None else _NoCondition()
+
+        self._size = min_pool_size
+        for _ in range(min_pool_size):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        "Open and authenticate a connection. The caller has counted it in self._size."
+        try:
+            connection = self._connection_class(
+                self.host, self.port, self.ssl_ca_certs, self.compressors, self.compression_threshold,
+                self.connect_timeout, self.socket_timeout,
+            )
+            if self.user:
+                connection.auth(self.user, self.password)
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._adopt(connection)
+        return connection
+
+    def _checkout(self, connection=None):
+        "Borrow a connection, the given one if it is still open"
+        deadline = None
+        if self.wait_queue_timeout is not None:
+            deadline = _monotonic() + self.wait_queue_timeout
+        with self._cond:
+            self._stats['checkouts'] += 1
+            c = self._take(connection)
+            while c is False:
+                self._cond.wait(self._wait_timeout(deadline))
+                c = self._take(connection)
+        if c is None:
+            return self._connect()
+        return c
+
+    def auth(self, user, password):
+        "Authenticate the idle connections, and the ones opened later"
+        self.user = user
+        self.password = password
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+        try:
+            for connection in idle:
+                connection.auth(user, password)
+        finally:
+            for connection in idle:
+                self._checkin(connection)
+
+
+class MongoDatabase:
+    _collection_class = MongoCollection
+    _pipeline_class = Pipeline
+    _prepared_class = PreparedCommand
+
+    def __init__(self, client, database, read_preference=None):
+        self.client = client
+        self.host = client.host
+        self.port = client.port
+        self.user = client.user
+        self.password = client.password
+        self.database = database
+        self.read_preference = read_preference  # None for the one of the client
+
+    def _command(self, metadata, database=None, document_class=dict, binary_view=False, exhaust=False,
+                 connection=None, cursor=None):
+        "Run a command on a borrowed connection, the given one if it is open. Return the reply and the connection."
+        if database is None:
+            database = self.database
+        client, metadata = self.client._select(metadata, self.read_preference, connection)
+        connection = client._checkout(connection)
+        try:
+            r = connection.runCommand(metadata, database, document_class, binary_view, exhaust, cursor)
+        except BaseException:
+            connection._fail()
+            raise
+        finally:
+            client._checkin(connection)
+        return r, connection
+
+    def _run(self, metadata, handler, database=None):
+        "Run a command and return handler(database, reply, connection)"
+        r, connection = self._command(metadata, database)
+        return handler(self, r, connection)
+
+    def _receive(self, connection, cursor, document_class=dict, binary_view=False, drain=False):
+        "Read the next reply of the exhaust stream of cursor on connection, or drop the rest of it"
+        client = self.client._select(None, None, connection)[0]
+        c = client._checkout(connection)
+        try:
+            if c is not connection or connection._exhaust_cursor is not cursor:
+                raise OperationalError("exhaust cursor was interrupted by another command")
+            if drain:
+                connection._exhaust_cursor = None
+                connection._drain()
+                return None
+            return connection._recv_reply(document_class, binary_view)
+        except OperationalError:
+            raise
+        except BaseException:
+            c._fail()
+            raise
+        finally:
+            client._checkin(c)
+
     def __getattr__(self, name):
         if name[0] == '_':
             raise AttributeError
-        return MongoCollection(self, name)
+        return self._collection_class(self, name)
 
-    def auth(self, user, password):
-        # https://github.com/mongodb/specifications/blob/master/source/auth/auth.rst#scram-sha-256
-        printable = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/'
-        nonce = ''.join(printable[random.randrange(0, len(printable))] for i in range(32))
-        r = self.runCommand({
-            'saslStart': 1.0,
-            'mechanism': 'SCRAM-SHA-256',
-            'payload': ('n,,n=%s,r=%s' % (user, nonce)).encode('utf-8'),
-        }, database='admin')
-        if not r['ok']:
-            raise OperationalError(r['errmsg'])
-        reply_payload = {s[0]: s[2:] for s in r['payload'].decode('utf-8').split(',')}
-        reply_payload['i'] = int(reply_payload['i'])
-        assert reply_payload['r'][:len(nonce)] == nonce
-
-        # Password is used as-is (UTF-8 encoded), no MD5 hashing
-        prep_password = password.encode('utf-8')
-        salted_pass = pbkdf2_hmac_sha256(
-            prep_password,
-            base64_decode(reply_payload['s']),
-            reply_payload['i'],
-        )
-        hmac_fn = hmac_sha256_digest
-        hash_fn = hashlib.sha256
-
-        client_key = hmac_fn(salted_pass, b"Client Key")
-        auth_msg = b"n=%s,r=%s,%s,c=biws,r=%s" % (
-            user.encode('utf-8'),
-            nonce.encode('utf-8'),r['payload'],
-            reply_payload['r'].encode('utf-8'),
-        )
-        client_sig = hmac_fn(hash_fn(client_key).digest(), auth_msg)
-        proof = base64_encode(
-            b"".join([bytes([x ^ y]) for x, y in zip(client_key, client_sig)])
-        )
-        payload = ("c=biws,r=%s,p=" % reply_payload['r']).encode('utf-8') + proof
+    @property
+    def compressor(self):
+        return self.client.compressor
 
-        k = hmac_fn(salted_pass, b"Server Key")
-        server_sig = base64_encode(hmac_fn(k, auth_msg)).decode('utf-8')
+    @property
+    def bytes_saved_sent(self):
+        return self.client.bytes_saved_sent
 
-        r = self.runCommand({
-            'saslContinue': 1.0,
-            'conversationId': r['conversationId'],
-            'payload': payload,
-        }, database='admin')
-        if not r['ok']:
-            raise OperationalError(r['errmsg'])
-        reply_payload = {s[0]: s[2:] for s in r['payload'].decode('utf-8').split(',')}
+    @property
+    def bytes_saved_received(self):
+        return self.client.bytes_saved_received
 
-        assert reply_payload['v'] == server_sig
+    @property
+    def max_bson_object_size(self):
+        return self.client.max_bson_object_size
 
-        if not r['done']:
-            r = self.runCommand({
-                'saslContinue': 1.0,
-                'conversationId': r['conversationId'],
-                'payload': b'',
-            }, database='admin')
-            if not r['ok']:
-                raise OperationalError(r['errmsg'])
+    @max_bson_object_size.setter
+    def max_bson_object_size(self, v):
+        self.client.max_bson_object_size = v
+
+    @property
+    def max_message_size_bytes(self):
+        return self.client.max_message_size_bytes
+
+    @max_message_size_bytes.setter
+    def max_message_size_bytes(self, v):
+        self.client.max_message_size_bytes = v
+
+    @property
+    def max_write_batch_size(self):
+        return self.client.max_write_batch_size
+
+    @max_write_batch_size.setter
+    def max_write_batch_size(self, v):
+        self.client.max_write_batch_size = v
+
+    def auth(self, user, password):
+        return self.client.auth(user, password)
 
     def genObjectId(self):
-        self._object_id_counter = (self._object_id_counter + 1) & 0xffffff
-        return ObjectId(
-            self._get_time_bytes() +
-            self._machine_id_bytes +
-            self._process_id_bytes +
-            bytes(reversed(from_int32(self._object_id_counter)[:3]))
-        )
+        return self.client.genObjectId()
 
     def commandHelp(self, name):
-        r = self.runCommand({'help': 1.0, name: 1.0})
-        if r['ok']:
-            return r['help']
-        raise OperationalError(r['errmsg'])
+        return self._run({'help': 1.0, name: 1.0}, _reply_field('help'))
 
     def createCollection(self, name, options={}):
         params = options.copy()
@@ -1225,43 +3396,48 @@ class MongoDatabase:
     def dropDatabase(self):
         return self.runCommand({'dropDatabase': 1.0})
 
+    def _collection_infos(self, handler):
+        "Run listCollections and return handler(database, collection infos)"
+        def result(db, r, connection):
+            if r['ok']:
+                return handler(db, r['cursor']['firstBatch'])
+            raise OperationalError(r['errmsg'])
+        return self._run({'listCollections': 1.0}, result)
+
     def getCollectionInfos(self):
-        r = self.runCommand({'listCollections': 1.0})
-        if r['ok']:
-            return r['cursor']['firstBatch']
-        raise OperationalError(r['errmsg'])
+        return self._collection_infos(lambda db, infos: infos)
 
     def getCollectionNames(self):
-        return [r['name'] for r in self.getCollectionInfos()]
+        return self._collection_infos(lambda db, infos: [r['name'] for r in infos])
 
     def getCollection(self, name):
-        if name in self.getCollectionNames():
-            return MongoCollection(self, name)
-        raise OperationalError("'%s' is not collection name" % (name, ))
+        def result(db, infos):
+            if name in [r['name'] for r in infos]:
+                return db._collection_class(db, name)
+            raise OperationalError("'%s' is not collection name" % (name, ))
+        return self._collection_infos(result)
 
     def getCollections(self):
-        return [MongoCollection(self, name) for name in self.getCollectionNames()]
+        return self._collection_infos(lambda db, infos: [db._collection_class(db, r['name']) for r in infos])
 
     def getLastError(self):
-        return self.getLastErrorObj()['err']
+        return self._run({'getlasterror': 1.0}, lambda db, r, connection: r['err'])
 
     def getLastErrorObj(self):
         return self.runCommand({'getlasterror': 1.0})
 
     def getLogComponents(self):
-        r = self.runCommand({'getParameter': 1.0, 'logComponentVerbosity': 1.0})
-        if r['ok']:
-            return r['cursor']['logComponentVerbosity']
-        raise OperationalError(r['errmsg'])
+        def result(db, r, connection):
+            if r['ok']:
+                return r['cursor']['logComponentVerbosity']
+            raise OperationalError(r['errmsg'])
+        return self._run({'getParameter': 1.0, 'logComponentVerbosity': 1.0}, result)
 
     def getPrevError(self):
         return self.runCommand({'getpreverror': 1.0})
 
     def hostInfo(self):
-        r = self.runCommand({'hostInfo': 1.0})
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+        return self._run({'hostInfo': 1.0}, _reply_field())
 
     def isMaster(self):
         return self.runCommand({'isMaster': 1.0})
@@ -1269,24 +3445,18 @@ class MongoDatabase:
     def listCommands(self):
         return self.runCommand({'listCommands': 1.0})
 
-    def repairDatabase(self):
-        r = self.runCommand({'repairDatabase': 1.0})
-        if r['ok']:
-            return r
-        raise OperationalError(r['errmsg'])
+    def pipeline(self):
+        return self._pipeline_class(self)
 
-    def runCommand(self, metadata, database=None):
-        if database is None:
-            database = self.database
-        self._send(_op_msg(self._request_id, database, metadata))
-        self._request_id += 1
+    def prepare(self, metadata, variables, database=None, document_class=dict, binary_view=False):
+        "PreparedCommand of constant fields metadata and variable fields named in variables"
+        return self._prepared_class(self, metadata, variables, database, document_class, binary_view)
 
-        head = self._recv(16)
-        ln = to_uint(head[0:4])
-        opcode = to_uint(head[12:16])
-        assert opcode == OP_MSG_OPCODE, "Unexpected opcode: %d" % opcode
-        data = self._recv(ln - 16)
-        return _op_msg_reply(data)
+    def repairDatabase(self):
+        return self._run({'repairDatabase': 1.0}, _reply_field())
+
+    def runCommand(self, metadata, database=None, document_class=dict, binary_view=False, exhaust=False):
+        return self._command(metadata, database, document_class, binary_view, exhaust)[0]
 
     def serverBuildInfo(self):
         return self.runCommand({'buildInfo': 1.0})
@@ -1298,11 +3468,1014 @@ class MongoDatabase:
         return self.runCommand({'dbStats': 1.0, 'scale': scale})
 
     def version(self):
-        return self.serverBuildInfo()['version']
+        return self._run({'buildInfo': 1.0}, lambda db, r, connection: r['version'])
 
     def close(self):
-        self._sock.close()
+        self.client.close()
+
+
+class MultiplexedClient(MongoClient):
+    """One MultiplexedConnection shared by threads, a lighter alternative to the pool of MongoClient
+    where the server allows few connections. It is opened again when it fails.
+    """
+    _connection_class = MultiplexedConnection
+
+    def __init__(self, host, user=None, password='', port=27017, ssl_ca_certs=None, compressors=None,
+                 compression_threshold=1024, connect_timeout=None, socket_timeout=None):
+        MongoClient.__init__(
+            self, host, user, password, port, ssl_ca_certs, compressors, compression_threshold,
+            connect_timeout, socket_timeout, min_pool_size=1, max_pool_size=1,
+        )
+
+    def _checkout(self, connection=None):
+        "The shared connection, opened again if it is closed"
+        with self._cond:
+            self._stats['checkouts'] += 1
+            while True:
+                if self._idle:
+                    c = self._idle[0]
+                    if not c.closed:
+                        return c
+                    self._idle.remove(c)
+                    self._retire(c)
+                if self._size == 0:
+                    self._size += 1
+                    break
+                self._stats['waits'] += 1
+                self._cond.wait()
+        c = self._connect()
+        with self._cond:
+            self._idle.append(c)
+        return c
+
+    def _checkin(self, connection):
+        if connection.closed:
+            with self._cond:
+                if connection in self._idle:
+                    self._idle.remove(connection)
+                    self._retire(connection)
+
+    def auth(self, user, password):
+        self.user = user
+        self.password = password
+        with self._cond:
+            idle = list(self._idle)
+        for connection in idle:
+            connection.auth(user, password)
+
+
+# read commands that may run on a secondary
+SECONDARY_OK_COMMANDS = set(['find', 'aggregate', 'count', 'distinct'])
+READ_PREFERENCES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest')
+# checks of the topology asked by failed commands are not run more often than this
+_MIN_HEARTBEAT_INTERVAL = 0.5
+
+
+def _parse_address(address, default_port=27017):
+    "(host, port) of 'host', 'host:port' or (host, port)"
+    if isinstance(address, (tuple, list)):
+        return address[0], int(address[1])
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        return address, default_port
+    return host, int(port)
+
+
+def _secondary_ok(metadata):
+    "True if the command may read from a secondary"
+    if metadata is None:
+        return False
+    name = _command_name(metadata)
+    if name not in SECONDARY_OK_COMMANDS:
+        return False
+    if name == 'aggregate':
+        for stage in metadata.get('pipeline', []):
+            if '$out' in stage or '$merge' in stage:
+                return False
+    return True
+
+
+class _ServerPool(MongoClient):
+    "MongoClient of a ReplicaSetClient member, asking for a check of the topology when a connection fails"
+    topology = None
+
+    def _connect(self):
+        try:
+            return MongoClient._connect(self)
+        except Exception:
+            if self.topology is not None:
+                self.topology._request_check()
+            raise
+
+    def _checkin(self, connection):
+        if connection.closed and self.topology is not None:
+            self.topology._request_check()
+        MongoClient._checkin(self, connection)
+
+
+class _Server:
+    "A member of a replica set as its monitor sees it"
+    def __init__(self, client, host, port):
+        self.host = host
+        self.port = port
+        self.kind = 'unknown'   # 'primary', 'secondary', 'standalone', 'arbiter', 'other' or 'unknown'
+        self.rtt = None         # smoothed round trip time of hello in seconds
+        self.error = None       # of the last check
+        self.monitor = None     # MongoConnection running hello
+        self.pool = _ServerPool(
+            host, client.user, client.password, port, client.ssl_ca_certs, client.compressors,
+            client.compression_threshold, client.connect_timeout, client.socket_timeout,
+            0, client.max_pool_size, client.max_idle_time, client.wait_queue_timeout,
+        )
+        # connections are opened when they are needed, then min_pool_size of them are kept
+        self.pool.min_pool_size = client.min_pool_size
+        self.pool.topology = client
+
+    def close(self):
+        self.pool.topology = None
+        if self.monitor is not None:
+            self.monitor.close()
+        self.pool.close()
+
+
+class ReplicaSetClient(_Client):
+    """Client of a replica set found from seeds, 'host:port' of some of its members.
+    A monitor thread runs hello on each member every heartbeat_frequency seconds, measuring its round trip
+    time and following the primary. Each member has a MongoClient pool with the pool settings.
+    find, aggregate, count and distinct go to a member chosen by read_preference, one of READ_PREFERENCES,
+    at random among those within local_threshold seconds of the nearest. Other commands go to the primary.
+    A command waits up to server_selection_timeout seconds for a suitable member.
+    """
+    def __init__(self, seeds, user=None, password='', ssl_ca_certs=None, compressors=None,
+                 compression_threshold=1024, connect_timeout=None, socket_timeout=None,
+                 min_pool_size=0, max_pool_size=100, max_idle_time=None, wait_queue_timeout=None,
+                 replica_set=None, read_preference='primary', heartbeat_frequency=10.0, local_threshold=0.015,
+                 server_selection_timeout=30.0):
+        if isinstance(seeds, str):
+            seeds = seeds.split(',')
+        seeds = [_parse_address(a) for a in seeds]
+        _Client.__init__(
+            self, seeds[0][0], user, password, seeds[0][1], ssl_ca_certs, compressors, compression_threshold,
+            connect_timeout, socket_timeout, min_pool_size, max_pool_size, max_idle_time, wait_queue_timeout,
+        )
+        if read_preference not in READ_PREFERENCES:
+            raise ValueError("unknown read preference '%s'" % read_preference)
+        self.replica_set = replica_set
+        self.read_preference = read_preference
+        self.heartbeat_frequency = heartbeat_frequency
+        self.local_threshold = local_threshold
+        self.server_selection_timeout = server_selection_timeout
+        self._servers = {}
+        for host, port in seeds:
+            self._servers[(host, port)] = _Server(self, host, port)
+        # threading.Condition is reentrant, topology changes happen with it held
+        self._cond = threading.Condition() if threading is not None else _NoCondition()
+        self._closed = False
+        self._check_requested = False
+        self._last_check = 0.0
+        self._check_all()
+        self._monitor = None
+        if threading is not None:
+            self._monitor = threading.Thread(target=self._run_monitor)
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def _run_monitor(self):
+        while True:
+            with self._cond:
+                deadline = self._last_check + self.heartbeat_frequency
+                while not (self._closed or self._check_requested) and _monotonic() < deadline:
+                    self._cond.wait(deadline - _monotonic())
+                if self._closed:
+                    return
+                self._check_requested = False
+            wait = self._last_check + _MIN_HEARTBEAT_INTERVAL - _monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._check_all()
+
+    def _request_check(self):
+        with self._cond:
+            self._check_requested = True
+            self._cond.notify_all()
+
+    def _check_all(self):
+        "Run hello on each member, and on the members it finds, then wake the commands waiting for one"
+        checked = set()
+        while True:
+            with self._cond:
+                servers = [x for x in self._servers.values() if x not in checked]
+            if not servers or self._closed:
+                break
+            for server in servers:
+                self._check(server)
+                checked.add(server)
+        with self._cond:
+            self._last_check = _monotonic()
+            self._cond.notify_all()
+
+    def _check(self, server):
+        with self._cond:
+            if self._servers.get((server.host, server.port)) is not server:
+                # removed by the check of another member during this pass
+                return
+        # the monitor does not wait for ever, 10 seconds is the usual connect timeout
+        timeout = self.connect_timeout if self.connect_timeout is not None else 10.0
+        try:
+            if server.monitor is None:
+                server.monitor = MongoConnection(
+                    server.host, server.port, self.ssl_ca_certs, self.compressors, self.compression_threshold,
+                    timeout, timeout,
+                )
+            start = _monotonic()
+            r = server.monitor.runCommand({'hello': 1.0}, 'admin')
+            if not r['ok']:
+                r = server.monitor.runCommand({'isMaster': 1.0}, 'admin')
+            rtt = _monotonic() - start
+        except Exception as e:
+            if server.monitor is not None:
+                server.monitor.close()
+                server.monitor = None
+            with self._cond:
+                server.kind = 'unknown'
+                server.rtt = None
+                server.error = e
+            server.pool.close()
+            return
+        with self._cond:
+            if self._servers.get((server.host, server.port)) is server:
+                self._update(server, r, rtt)
+                return
+        # removed while hello ran
+        server.close()
+
+    def _update(self, server, r, rtt):
+        "Take the reply to hello of server into the topology, with self._cond held"
+        server.rtt = rtt if server.rtt is None else 0.2 * rtt + 0.8 * server.rtt
+        server.error = None
+        if not self._learned:
+            self._learned = True
+            self.compressor = server.monitor.compressor
+            self.max_bson_object_size = server.monitor.max_bson_object_size
+            self.max_message_size_bytes = server.monitor.max_message_size_bytes
+            self.max_write_batch_size = server.monitor.max_write_batch_size
+        set_name = r.get('setName')
+        if set_name is None:
+            server.kind = 'standalone'
+            return
+        if self.replica_set is None:
+            self.replica_set = set_name
+        elif set_name != self.replica_set:
+            self._remove((server.host, server.port))
+            return
+        members = [_parse_address(a) for a in r.get('hosts', []) + r.get('passives', []) + r.get('arbiters', [])]
+        for address in members:
+            if address not in self._servers:
+                self._servers[address] = _Server(self, address[0], address[1])
+        if r.get('isWritablePrimary') or r.get('ismaster'):
+            server.kind = 'primary'
+            for address, other in list(self._servers.items()):
+                if address not in members and other is not server:
+                    self._remove(address)
+                elif other.kind == 'primary' and other is not server:
+                    # stale, until its next check
+                    other.kind = 'unknown'
+        elif r.get('secondary'):
+            server.kind = 'secondary'
+        elif r.get('arbiterOnly'):
+            server.kind = 'arbiter'
+        else:
+            server.kind = 'other'
+
+    def _remove(self, address):
+        server = self._servers.pop(address)
+        server.close()
+
+    def _after_fork(self):
+        # the pools of the members are started afresh on their own
+        _Client._after_fork(self)
+        for server in self._servers.values():
+            if server.monitor is not None:
+                server.monitor._forget()
+                server.monitor = None
+        if self._monitor is not None and not self._closed:
+            self._check_requested = True
+            self._monitor = threading.Thread(target=self._run_monitor)
+            self._monitor.daemon = True
+            self._monitor.start()
+
+    def _candidates(self, mode):
+        "Members that mode can read from, with self._cond held"
+        primaries = []
+        secondaries = []
+        for server in self._servers.values():
+            if server.kind in ('primary', 'standalone'):
+                primaries.append(server)
+            elif server.kind == 'secondary':
+                secondaries.append(server)
+        if mode == 'primary':
+            return primaries
+        if mode == 'primaryPreferred':
+            return primaries or self._nearest(secondaries)
+        if mode == 'secondary':
+            return self._nearest(secondaries)
+        if mode == 'secondaryPreferred':
+            return self._nearest(secondaries) or primaries
+        return self._nearest(primaries + secondaries)
+
+    def _nearest(self, servers):
+        if not servers:
+            return servers
+        fastest = min(server.rtt for server in servers)
+        return [server for server in servers if server.rtt <= fastest + self.local_threshold]
+
+    def _choose(self, mode):
+        "A member for mode, waiting for the monitor to find one"
+        deadline = _monotonic() + self.server_selection_timeout
+        if self._monitor is None and _monotonic() - self._last_check > self.heartbeat_frequency:
+            self._check_all()
+        with self._cond:
+            servers = self._candidates(mode)
+            while not servers:
+                timeout = deadline - _monotonic()
+                if timeout <= 0 or self._closed:
+                    raise OperationalError("no member of the replica set for read preference '%s'" % mode)
+                if self._monitor is None:
+                    self._check_all()
+                    deadline = 0
+                else:
+                    self._check_requested = True
+                    self._cond.notify_all()
+                    self._cond.wait(timeout)
+                servers = self._candidates(mode)
+        return servers[random.randrange(len(servers))]
+
+    def _select(self, metadata, read_preference=None, connection=None):
+        "The pool of the member to run metadata on and the command to send"
+        if connection is not None:
+            # getMore and killCursors go where the cursor is
+            with self._cond:
+                server = self._servers.get((connection.host, connection.port))
+            if server is None:
+                raise OperationalError("%s:%d left the replica set" % (connection.host, connection.port))
+            return server.pool, metadata
+        mode = read_preference or self.read_preference
+        if mode == 'primary' or not _secondary_ok(metadata):
+            return self._choose('primary').pool, metadata
+        metadata = dict(metadata)
+        metadata['$readPreference'] = {'mode': mode}
+        return self._choose(mode).pool, metadata
+
+    def topology(self):
+        "{'host:port': {'type': ..., 'rtt': seconds}} of the known members"
+        with self._cond:
+            return dict(
+                ('%s:%d' % address, {'type': server.kind, 'rtt': server.rtt})
+                for address, server in self._servers.items()
+            )
+
+    def auth(self, user, password):
+        self.user = user
+        self.password = password
+        with self._cond:
+            servers = list(self._servers.values())
+        for server in servers:
+            server.pool.auth(user, password)
+
+    @property
+    def bytes_saved_sent(self):
+        with self._cond:
+            return sum(server.pool.bytes_saved_sent for server in self._servers.values())
+
+    @property
+    def bytes_saved_received(self):
+        with self._cond:
+            return sum(server.pool.bytes_saved_received for server in self._servers.values())
+
+    def pool_stats(self):
+        with self._cond:
+            servers = list(self._servers.items())
+        return dict(('%s:%d' % address, server.pool.pool_stats()) for address, server in servers)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            servers = list(self._servers.values())
+        for server in servers:
+            server.close()
+
+
+MongoClient._database_class = MongoDatabase
+ReplicaSetClient._database_class = MongoDatabase
+
+
+def connect(host, database, user=None, password='', port=27017, ssl_ca_certs=None, compressors=None,
+            compression_threshold=1024, connect_timeout=None, socket_timeout=None, read_preference='primary'):
+    """compressors is a list of names in COMPRESSORS ('zstd', 'zlib') in order of preference.
+    Messages shorter than compression_threshold bytes are sent uncompressed.
+    connect_timeout and socket_timeout are in seconds, None waits forever.
+    The database has one connection, use MongoClient for a pool shared by threads.
+    host can be a list of 'host:port' of replica set members, the database then has a connection
+    to each member that read_preference sends reads to, see ReplicaSetClient.
+    """
+    if isinstance(host, (list, tuple)):
+        client = ReplicaSetClient(
+            host, user, password, ssl_ca_certs, compressors, compression_threshold,
+            connect_timeout, socket_timeout, max_pool_size=1, read_preference=read_preference,
+        )
+        return client.get_database(database)
+    client = MongoClient(
+        host, user, password, port, ssl_ca_certs, compressors, compression_threshold,
+        connect_timeout, socket_timeout, min_pool_size=1, max_pool_size=1,
+    )
+    return client.get_database(database)
+
+
+class AsyncMongoConnection(_Connection):
+    """An asyncio stream to the server, used by one task at a time.
+    AsyncMongoDatabase borrows one from its AsyncMongoClient for each operation.
+    """
+    @classmethod
+    async def open(cls, host, port, ssl_ca_certs, compressors=None, compression_threshold=1024,
+                   connect_timeout=None, socket_timeout=None):
+        import asyncio
+        self = cls(host, port, compression_threshold, socket_timeout)
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=_ssl_context(ssl_ca_certs), server_hostname=host), connect_timeout)
+        try:
+            await self._handshake(compressors or [])
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    async def _read(self, n):
+        if self.socket_timeout is None:
+            return await self._reader.readexactly(n)
+        import asyncio
+        return await asyncio.wait_for(self._reader.readexactly(n), self.socket_timeout)
+
+    async def _send_message(self, chunks, command_name):
+        "Send an OP_MSG given as a list of buffers, stamped with the next request id, and return the id"
+        if self._more_to_come:
+            await self._drain()
+        request_id, chunks = self._stamp(chunks, command_name)
+        self._writer.writelines(chunks)
+        await self._writer.drain()
+        return request_id
+
+    async def _exchange(self, messages):
+        "MongoConnection._exchange on the stream"
+        if self._more_to_come:
+            await self._drain()
+        pending = {}
+        frames = []
+        for n, (chunks, command_name) in enumerate(messages):
+            request_id, chunks = self._stamp(chunks, command_name)
+            pending[request_id] = n
+            frames.append(chunks)
+        self._writer.writelines(_coalesce(frames))
+        await self._writer.drain()
+        replies = [None] * len(messages)
+        while pending:
+            data = await self._recv_msg()
+            replies[pending.pop(self._response_to)] = data
+        return replies
+
+    async def _handshake(self, compressors):
+        params = self._hello(compressors)
+        r = await self.runCommand(params, database='admin')
+        if not r['ok']:
+            del params['hello']
+            params['isMaster'] = 1.0
+            r = await self.runCommand(params, database='admin')
+        self._learn(r)
+
+    async def _recv_msg(self):
+        head = await self._read(16)
+        ln, _, self._response_to, opcode = _MSG_HEADER.unpack_from(head, 0)
+        body = await self._read(ln - 16)
+        return self._message(opcode, memoryview(body), 0, ln - 16)
+
+    async def _recv_reply(self, document_class=dict, binary_view=False):
+        return _op_msg_reply(await self._recv_msg(), _decode_options(document_class, binary_view))
+
+    async def _drain(self):
+        self._exhausted()
+        while self._more_to_come:
+            await self._recv_msg()
+
+    def _check(self):
+        "False if the server closed the connection"
+        return not self._reader.at_eof()
+
+    async def auth(self, user, password):
+        conversation = _scram_sha256(user, password)
+        r = None
+        while True:
+            try:
+                params = conversation.send(r)
+            except StopIteration:
+                return
+            r = await self.runCommand(params, database='admin')
+
+    async def runCommand(self, metadata, database, document_class=dict, binary_view=False, exhaust=False,
+                         cursor=None):
+        flags = EXHAUST_ALLOWED if exhaust else 0
+        await self._send_message(_op_msg(0, database, metadata, flags), next(iter(metadata)))
+        r = await self._recv_reply(document_class, binary_view)
+        if self._more_to_come:
+            self._exhaust_cursor = cursor
+        return r
+
+    def close(self):
+        self.closed = True
+        self._writer.close()
+
+
+class _AsyncPrefetcher(_Prefetcher):
+    "_Prefetcher reading in a task of the event loop"
+    def _start(self, depth):
+        import asyncio
+        self._batches = asyncio.Queue()
+        self._room = asyncio.Semaphore(depth)
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        error = None
+        try:
+            try:
+                while self.next_id:
+                    await self._room.acquire()
+                    if self._stopped:
+                        break
+                    r, self.connection = await self.collection._getMore(
+                        self.next_id, self.batchSize, self.document_class, self.binary_view, False, self.connection)
+                    self.next_id = r['cursor']['id'] if r['ok'] else 0
+                    self._batches.put_nowait(r)
+            except Exception as e:
+                error = e
+        finally:
+            # also when the task is cancelled
+            if self.next_id:
+                try:
+                    await self.collection.db._command(
+                        {'killCursors': self.collection.name, 'cursors': [self.next_id]}, connection=self.connection)
+                except Exception:
+                    pass
+                self.next_id = 0
+        if error is not None:
+            self._batches.put_nowait(error)
+
+    async def take(self):
+        r = await self._batches.get()
+        self._room.release()
+        return r
+
+    async def join(self):
+        await self._worker
+
+
+class AsyncMongoCursor(MongoCursor):
+    "MongoCursor of the asyncio client, read it with async for, await fetchone() or await fetchall()"
+    def _start_prefetch(self, depth):
+        self._prefetcher = _AsyncPrefetcher(self, depth)
+
+    async def _getMore(self):
+        if self._prefetcher is not None:
+            self._prefetched_batch(await self._prefetcher.take())
+            return
+        if self.connection is not None and self.connection._exhaust_cursor is self:
+            r = await self.collection.db._receive(self.connection, self, self.document_class, self.binary_view)
+        else:
+            r, self.connection = await self.collection._getMore(
+                self.next_id, self.batchSize, self.document_class, self.binary_view, self.exhaust,
+                self.connection, self)
+        self._set_batch(r)
+
+    async def _next_batch(self):
+        if self._needs_more():
+            await self._getMore()
+        return self._take_batch()
+
+    async def fetchone(self):
+        if self._needs_more():
+            await self._getMore()
+        return self._next()
+
+    async def fetchall(self):
+        rs = []
+        r = await self.fetchone()
+        while r is not None:
+            rs.append(r)
+            r = await self.fetchone()
+        return rs
+
+    async def to_columns(self, fields, dtypes={}, fill_values={}, masks=False):
+        columns = self._columns(fields, dtypes, fill_values, masks)
+        while True:
+            try:
+                next(columns)
+            except StopIteration as e:
+                return e.value
+            await self._getMore()
+
+    def __iter__(self):
+        raise TypeError("use async for with AsyncMongoCursor")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        r = await self.fetchone()
+        if r is None:
+            raise StopAsyncIteration()
+        return r
+
+    async def close(self):
+        db = self.collection.db
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            await self._prefetcher.join()
+            self._prefetcher = None
+            self.next_id = 0
+        if self.connection is not None and self.connection._exhaust_cursor is self:
+            await db._receive(self.connection, self, drain=True)
+        elif self.next_id:
+            await db._command({'killCursors': self.collection.name, 'cursors': [self.next_id]},
+                              connection=self.connection)
+        self.batch = []
+        self.next_index = 0
+        self.next_id = 0
+
+    def __enter__(self):
+        raise TypeError("use async with with AsyncMongoCursor")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncMongoCollection(MongoCollection):
+    "MongoCollection of the asyncio client, its methods return awaitables"
+    _cursor_class = AsyncMongoCursor
+
+    async def _run(self, params, handler, document_class=dict, binary_view=False):
+        r, connection = await self.db._command(params, None, document_class, binary_view)
+        return handler(self, r, connection)
+
+    async def _run_batches(self, params, identifier, batches, handler):
+        r = None
+        for offset, batch in batches:
+            params[identifier] = batch
+            x, connection = await self.db._command(params)
+            r = x if r is None else _merge_write_replies(r, x, offset)
+            if not x['ok'] or 'writeErrors' in x:
+                break
+        return handler(self, r, connection)
+
+    async def parallel_find(self, query={}, partitions=4, key='_id', projection=None, batchSize=None,
+                            document_class=dict, merge=True):
+        """parallel_find() of the asyncio client, the partitions are read by tasks on their own connections.
+        Return an async iterator over the documents, or with merge=False the AsyncMongoCursor of each partition.
+        """
+        import asyncio
+        sampling = self._boundaries(query, partitions, key)
+        r = None
+        while True:
+            try:
+                params = sampling.send(r)
+            except StopIteration as e:
+                queries = _partition_queries(query, key, e.value)
+                break
+            r = await self.db.runCommand(params)
+        cursors = await asyncio.gather(*[self.find(q, projection, batchSize, document_class) for q in queries])
+        if not merge:
+            return cursors
+        return _MergedScans(cursors, 2 * len(cursors))
+
+
+async def _scan_async(cursor, batches):
+    "Put the batches of cursor on batches, then None or the error that stopped it"
+    try:
+        try:
+            while True:
+                batch = await cursor._next_batch()
+                if batch:
+                    await batches.put(batch)
+                elif not cursor.next_id:
+                    break
+        except Exception as e:
+            await batches.put(e)
+            return
+        await batches.put(None)
+    finally:
+        # also when the task is cancelled
+        if cursor.next_id:
+            try:
+                await cursor.close()
+            except Exception:
+                pass
+
+
+class _MergedScans:
+    """_merge_scans among the tasks of an event loop, each cursor is read by a task.
+    An async iterator rather than an async generator, which MicroPython can not compile.
+    aclose() or dropping it stops the tasks, which kill the server cursors not read to their end.
+    """
+    def __init__(self, cursors, depth):
+        import asyncio
+        self._batches = asyncio.Queue(depth)
+        self._tasks = [asyncio.ensure_future(_scan_async(cursor, self._batches)) for cursor in cursors]
+        self._running = len(self._tasks)
+        self._batch = []
+        self._index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self._index == len(self._batch):
+            if not self._running:
+                raise StopAsyncIteration()
+            item = await self._batches.get()
+            if item is None:
+                self._running -= 1
+            elif isinstance(item, BaseException):
+                await self.aclose()
+                raise item
+            else:
+                self._batch = item
+                self._index = 0
+        d = self._batch[self._index]
+        self._index += 1
+        return d
+
+    async def aclose(self):
+        import asyncio
+        self._running = 0
+        self._batch = []
+        self._index = 0
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def __del__(self):
+        for t in self._tasks:
+            t.cancel()
+
+
+class AsyncPreparedCommand(PreparedCommand):
+    "PreparedCommand of the asyncio client, its calls return awaitables"
+    async def __call__(self, *args, **kwargs):
+        b = self._encode(args, kwargs)
+        client = self.db.client
+        connection = await client._checkout()
+        try:
+            data = (await connection._exchange([([b], self.command_name)]))[0]
+        except BaseException:
+            connection._fail()
+            raise
+        finally:
+            client._checkin(connection)
+        return self._result(data, connection)
+
+
+class AsyncPipelineCollection(PipelineCollection):
+    "PipelineCollection of an AsyncPipeline"
+    def _run_batches(self, params, identifier, batches, handler):
+        # a write split into batches runs in its turn when the pipeline is executed
+        return self.db._queue(self.name, (params, identifier, batches), handler)
+
+
+class AsyncPipeline(Pipeline):
+    "Pipeline of the asyncio client, use it with async with or await execute()"
+    def __getattr__(self, name):
+        if name[0] == '_':
+            raise AttributeError
+        return AsyncPipelineCollection(self, name)
+
+    async def runCommand(self, metadata, database=None, document_class=dict, binary_view=False, exhaust=False):
+        await self.execute()
+        return await self._db.runCommand(metadata, database, document_class, binary_view, exhaust)
+
+    async def execute(self):
+        queued, self._queued = self._queued, []
+        db = self._db
+        while queued:
+            # the commands up to a write split into batches are sent back to back
+            n = 0
+            while n < len(queued) and isinstance(queued[n][1], dict):
+                n += 1
+            if n:
+                await self._run_queued(queued[:n])
+            if n < len(queued):
+                collection_name, (params, identifier, batches), handler = queued[n][:3]
+                result = queued[n][-1]
+                try:
+                    result._value = await db._collection_class(db, collection_name)._run_batches(
+                        params, identifier, batches, handler)
+                except OperationalError as e:
+                    result._error = e
+                result.done = True
+            queued = queued[n + 1:]
+
+    async def _run_queued(self, queued):
+        client = self._db.client
+        connection = await client._checkout()
+        try:
+            replies = self._decode(await connection._exchange(self._messages(queued)), queued)
+        except BaseException:
+            connection._fail()
+            raise
+        finally:
+            client._checkin(connection)
+        self._deliver(queued, replies, connection)
+
+    def __enter__(self):
+        raise TypeError("use async with with AsyncPipeline")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.execute()
+        else:
+            self._queued = []
+
+
+class _TaskCondition:
+    "Stands in for threading.Condition among the tasks of an event loop, which need no lock"
+    def __init__(self):
+        self._waiters = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def wait(self, timeout=None):
+        import asyncio
+        event = asyncio.Event()
+        self._waiters.append(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            if event.is_set():
+                # pass the notification on
+                self.notify()
+        finally:
+            if event in self._waiters:
+                self._waiters.remove(event)
+
+    def notify(self):
+        if self._waiters:
+            self._waiters.pop(0).set()
+
+
+class AsyncMongoClient(_Client):
+    """Pool of connections to a server, shared by the tasks of an event loop.
+    The settings are those of MongoClient, but connections are only opened when they are needed.
+    """
+    def __init__(self, host, user=None, password='', port=27017, ssl_ca_certs=None, compressors=None,
+                 compression_threshold=1024, connect_timeout=None, socket_timeout=None,
+                 min_pool_size=0, max_pool_size=100, max_idle_time=None, wait_queue_timeout=None):
+        _Client.__init__(
+            self, host, user, password, port, ssl_ca_certs, compressors, compression_threshold,
+            connect_timeout, socket_timeout, min_pool_size, max_pool_size, max_idle_time, wait_queue_timeout,
+        )
+        self._cond = _TaskCondition()
+
+    async def _connect(self):
+        "Open and authenticate a connection. The caller has counted it in self._size."
+        try:
+            connection = await AsyncMongoConnection.open(
+                self.host, self.port, self.ssl_ca_certs, self.compressors, self.compression_threshold,
+                self.connect_timeout, self.socket_timeout,
+            )
+            if self.user:
+                await connection.auth(self.user, self.password)
+        except BaseException:
+            self._size -= 1
+            self._cond.notify()
+            raise
+        self._adopt(connection)
+        return connection
+
+    async def _checkout(self, connection=None):
+        "Borrow a connection, the given one if it is still open"
+        deadline = None
+        if self.wait_queue_timeout is not None:
+            deadline = _monotonic() + self.wait_queue_timeout
+        self._stats['checkouts'] += 1
+        c = self._take(connection)
+        while c is False:
+            await self._cond.wait(self._wait_timeout(deadline))
+            c = self._take(connection)
+        if c is None:
+            return await self._connect()
+        return c
+
+    async def auth(self, user, password):
+        "Authenticate the idle connections, and the ones opened later"
+        self.user = user
+        self.password = password
+        idle = self._idle
+        self._idle = []
+        try:
+            for connection in idle:
+                await connection.auth(user, password)
+        finally:
+            for connection in idle:
+                self._checkin(connection)
+
+
+class AsyncMongoDatabase(MongoDatabase):
+    "MongoDatabase of the asyncio client, its methods return awaitables"
+    _collection_class = AsyncMongoCollection
+    _pipeline_class = AsyncPipeline
+    _prepared_class = AsyncPreparedCommand
+
+    async def _command(self, metadata, database=None, document_class=dict, binary_view=False, exhaust=False,
+                       connection=None, cursor=None):
+        if database is None:
+            database = self.database
+        client = self.client
+        connection = await client._checkout(connection)
+        try:
+            r = await connection.runCommand(metadata, database, document_class, binary_view, exhaust, cursor)
+        except BaseException:
+            connection._fail()
+            raise
+        finally:
+            client._checkin(connection)
+        return r, connection
+
+    async def _run(self, metadata, handler, database=None):
+        r, connection = await self._command(metadata, database)
+        return handler(self, r, connection)
+
+    async def _receive(self, connection, cursor, document_class=dict, binary_view=False, drain=False):
+        client = self.client
+        c = await client._checkout(connection)
+        try:
+            if c is not connection or connection._exhaust_cursor is not cursor:
+                raise OperationalError("exhaust cursor was interrupted by another command")
+            if drain:
+                connection._exhaust_cursor = None
+                await connection._drain()
+                return None
+            return await connection._recv_reply(document_class, binary_view)
+        except OperationalError:
+            raise
+        except BaseException:
+            c._fail()
+            raise
+        finally:
+            client._checkin(c)
+
+    async def runCommand(self, metadata, database=None, document_class=dict, binary_view=False, exhaust=False):
+        return (await self._command(metadata, database, document_class, binary_view, exhaust))[0]
+
+
+AsyncMongoClient._database_class = AsyncMongoDatabase
+
+
+async def aio_connect(host, database, user=None, password='', port=27017, ssl_ca_certs=None, compressors=None,
+                      compression_threshold=1024, connect_timeout=None, socket_timeout=None, max_pool_size=100):
+    """connect() for asyncio, return an AsyncMongoDatabase.
+    Its pool opens up to max_pool_size connections for the tasks that run commands at the same time.
+    """
+    client = AsyncMongoClient(
+        host, user, password, port, ssl_ca_certs, compressors, compression_threshold,
+        connect_timeout, socket_timeout, max_pool_size=max_pool_size,
+    )
+    # fail now if the server can not be reached, and learn its limits
+    client._checkin(await client._checkout())
+    return client.get_database(database)
+
+
+def _aio_module():
+    "nmongo.aio, registered so that import nmongo.aio and from nmongo.aio import connect work like os.path"
+    try:
+        aio = type(sys)(__name__ + '.aio', "The asyncio client: db = await nmongo.aio.connect(...)")
+    except TypeError:
+        # MicroPython can not make modules, nmongo.aio is a class there
+        class aio:
+            pass
+    else:
+        sys.modules[aio.__name__] = aio
+    aio.connect = aio_connect
+    aio.MongoClient = AsyncMongoClient
+    aio.MongoDatabase = AsyncMongoDatabase
+    aio.MongoCollection = AsyncMongoCollection
+    aio.MongoCursor = AsyncMongoCursor
+    return aio
 
 
-def connect(host, database, user=None, password='', port=27017, ssl_ca_certs=None):
-    return MongoDatabase(host, database, user, password, port, ssl_ca_certs)
+aio = _aio_module()
@@ -35,6 +35,7 @@
 ###############################################################################
 import sys
 import os
+import time
 import unittest
 import datetime
 import nmongo
@@ -180,6 +181,464 @@ class TestBase:
             self.data2['name']
         )
 
+    def test_raw_document(self):
+        cur = self.db.pets.find({'name': 'Kitty'}, document_class=nmongo.RawDocument)
+        raw = cur.fetchone()
+        self.assertTrue(isinstance(raw, nmongo.RawDocument))
+        self.assertEqual(raw['name'], 'Kitty')
+        self.assertEqual(raw.get('species'), 'cat')
+        self.assertFalse('color' in raw)
+
+        # re-insert without decoding
+        self.db.pets_copy.drop()
+        self.db.pets_copy.insert(raw)
+        self.assertEqualDict(self.db.pets_copy.findOne(), dict(raw.items()))
+        self.db.pets_copy.drop()
+
+    def test_field_filter(self):
+        cur = self.db.pets.find({'name': 'Kitty'}, field_filter=['name', 'age'])
+        self.assertEqual(cur.fetchone(), {'name': 'Kitty', 'age': 0})
+
+        b = nmongo.bson_encode({'a': 1, 'b': {'c': 2, 'd': 'x'}, 'e': [{'c': 3, 'd': 'y'}]})
+        d, _ = nmongo.bson_decode(b, field_filter=['b.c', 'e.d'])
+        self.assertEqual(d, {'b': {'c': 2}, 'e': [{'d': 'y'}]})
+
+        # a bytearray decodes like bytes
+        self.assertEqual(nmongo.bson_decode(bytearray(b))[0], nmongo.bson_decode(b)[0])
+        self.assertEqual(nmongo.bson_decode(bytearray(b), field_filter=['b.c'])[0], {'b': {'c': 2}})
+        self.assertEqual(nmongo.RawDocument(bytearray(b))['b']['c'], 2)
+
+    def test_to_columns(self):
+        cur = self.db.pets.find(document_class=nmongo.RawDocument, batchSize=2)
+        columns, masks = cur.to_columns(
+            ['name', 'age', 'height'],
+            {'age': 'q', 'height': 'd'},
+            masks=True,
+        )
+        self.assertEqual(sorted(columns['name']), ['Kitty', 'Kuri', 'Snoopy'])
+        self.assertEqual(list(columns['age']), [0, 0, 0])
+        self.assertEqual(list(masks['age']), [1, 1, 1])
+        self.assertEqual(list(masks['height']), [0, 0, 0])
+
+        # the first batch is decoded to dict, the second one is not
+        self.db.columns.drop()
+        t = datetime.datetime(2024, 1, 1, 9, 0, 0, 123000)
+        self.db.columns.insert([{'_id': 1, 't': t, 'x': 1.5}, {'_id': 2, 't': t, 'x': None}])
+        columns, masks = self.db.columns.find(batchSize=1).to_columns(['t', 'x'], {'t': 'q', 'x': 'd'}, masks=True)
+        self.assertEqual(list(columns['t']), [nmongo._datetime_ms(t)] * 2)
+        self.assertEqual(columns['t'][0] % 1000, 123)
+        self.assertEqual(list(masks['x']), [1, 0])
+        self.db.columns.drop()
+
+    def test_register_codec(self):
+        class Color:
+            def __init__(self, name):
+                self.name = name
+
+        nmongo.register_encoder(Color, lambda c: c.name)
+        b = nmongo.bson_encode({'color': Color('red')})
+        self.assertEqual(nmongo.bson_decode(b)[0], {'color': 'red'})
+
+        decode_code = nmongo._bson_decoders[0x0d]
+        try:
+            nmongo.register_decoder(0x0d, lambda c: str(c))
+            b = nmongo.bson_encode({'f': nmongo.Code('function(){}')})
+            self.assertEqual(nmongo.bson_decode(b)[0], {'f': 'function(){}'})
+        finally:
+            nmongo._bson_decoders[0x0d] = decode_code
+
+        import uuid
+        import struct
+
+        def decode_binary(b, i):
+            ln = struct.unpack_from('<i', b, i)[0]
+            v = bytes(b[i+5:i+5+ln])
+            if b[i+4] == 4:
+                v = uuid.UUID(bytes=v)
+            return v, i + 5 + ln
+
+        def decode_min_key(b, i):
+            return 'MinKey', i
+
+        decode_binary_default = nmongo._bson_decoders[0x05]
+        try:
+            nmongo.register_decoder(0x05, decode_binary, raw=True)
+            nmongo.register_decoder(0xff, decode_min_key, raw=True)
+            u = uuid.uuid4()
+            b = nmongo.bson_encode({'u': nmongo.Binary(u.bytes, 4), 'b': b'abc'})
+            self.assertEqual(nmongo.bson_decode(b)[0], {'u': u, 'b': b'abc'})
+            # {'m': MinKey, 'i': 1}
+            body = b'\xffm\x00\x10i\x00\x01\x00\x00\x00'
+            b = struct.pack('<i', len(body) + 5) + body + b'\x00'
+            self.assertEqual(nmongo.bson_decode(b)[0], {'m': 'MinKey', 'i': 1})
+            self.assertEqual(nmongo.bson_decode(b, field_filter=['i'])[0], {'i': 1})
+        finally:
+            nmongo._bson_decoders[0x05] = decode_binary_default
+            del nmongo._bson_decoders[0xff]
+
+    def test_binary_view(self):
+        b = nmongo.bson_encode({'a': b'abc', 'u': nmongo.Binary(b'0123456789abcdef', 4)})
+        d, _ = nmongo.bson_decode(b)
+        self.assertEqual(d, {'a': b'abc', 'u': b'0123456789abcdef'})
+        self.assertEqual(type(d['a']), bytes)
+        self.assertEqual(type(d['u']), bytes)
+        d, _ = nmongo.bson_decode(b, binary_view=True)
+        self.assertIsInstance(d['a'].data, memoryview)
+        self.assertEqual(d['a'].to_bytes(), b'abc')
+        self.assertEqual(d['u'].subtype, 4)
+        self.assertEqual(nmongo.bson_encode(d), b)
+        uuids = {d['u']: 1, nmongo.Binary(b'0123456789abcdef', 3): 2}
+        self.assertEqual(uuids[nmongo.Binary(b'0123456789abcdef', 4)], 1)
+
+    def test_document_sequence(self):
+        docs = [{'_id': i, 'v': 'x' * i} for i in range(100)]
+        data = b''.join(nmongo._op_msg(1, 'test', {'insert': 'c', 'documents': docs}))
+        self.assertEqual(len(data), int.from_bytes(data[:4], 'little'))
+        r = nmongo._op_msg_reply(data[16:])
+        self.assertEqual(r['insert'], 'c')
+        self.assertEqual(r['documents'], docs)
+
+        self.db.sequence.drop()
+        self.db.sequence.insert(docs)
+        self.assertEqual(self.db.sequence.count(), 100)
+
+    def test_compression(self):
+        db = nmongo.connect(
+            self.host,
+            self.database,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            ssl_ca_certs=self.ssl_ca_certs,
+            compressors=['zstd', 'zlib'],
+            compression_threshold=0,
+        )
+        try:
+            db.compressed.drop()
+            db.compressed.insert([{'_id': i, 's': 'abc' * 100} for i in range(100)])
+            self.assertEqual(len(db.compressed.find(batchSize=1000).fetchall()), 100)
+            if db.compressor is not None:
+                self.assertGreater(db.bytes_saved_sent, 0)
+        finally:
+            db.close()
+
+    def test_exhaust(self):
+        self.db.exhaust.drop()
+        self.db.exhaust.insert([{'_id': i} for i in range(250)])
+        cur = self.db.exhaust.find(batchSize=100, exhaust=True)
+        self.assertEqual(len(cur.fetchall()), 250)
+
+        with self.db.exhaust.find(batchSize=100, exhaust=True) as cur:
+            for _ in range(150):
+                cur.fetchone()
+        self.assertEqual(self.db.exhaust.count(), 250)
+
+    def test_prefetch(self):
+        self.db.prefetch.drop()
+        self.db.prefetch.insert([{'_id': i} for i in range(250)])
+        cur = self.db.prefetch.find(batchSize=100, prefetch=True)
+        self.assertEqual([d['_id'] for d in cur], list(range(250)))
+
+        with self.db.prefetch.find(batchSize=50, prefetch=2) as cur:
+            for _ in range(60):
+                cur.fetchone()
+        self.assertEqual(self.db.prefetch.count(), 250)
+
+        # a cursor dropped before its end stops reading ahead and kills the server cursor
+        cur = self.db.prefetch.find(batchSize=50, prefetch=2)
+        cur.fetchone()
+        prefetcher = cur._prefetcher
+        if prefetcher is not None:
+            del cur
+            prefetcher._worker.join(10)
+            self.assertFalse(prefetcher._worker.is_alive())
+            self.assertEqual(prefetcher.next_id, 0)
+
+    def test_pipeline(self):
+        with self.db.pipeline() as p:
+            n = p.pets.count()
+            kitty = p.pets.findOne({'name': 'Kitty'})
+            cats = p.pets.find({'species': 'cat'})
+            self.assertFalse(n.done)
+        self.assertEqual(n.value, 3)
+        self.assertEqual(kitty.value['name'], 'Kitty')
+        self.assertEqual(len(cats.value.fetchall()), 2)
+
+    def test_prepared(self):
+        find = self.db.pets.prepare_find(projection={'name': 1}, batchSize=10)
+        self.assertEqual(len(find({'species': 'cat'}).fetchall()), 2)
+        self.assertEqual(find({'name': 'Kuri'}).fetchone()['name'], 'Kuri')
+
+        count = self.db.prepare({'count': 'pets'}, ['query'])
+        self.assertEqual(count({'species': 'ferret'})['n'], 1)
+        self.assertEqual(count()['n'], 3)
+
+    def test_large_reply(self):
+        self.db.large.drop()
+        self.db.large.insert([{'_id': i, 'b': b'x' * 100000} for i in range(50)])
+        docs = self.db.large.find(batchSize=50).fetchall()
+        self.assertEqual(len(docs), 50)
+        self.assertEqual(docs[-1]['b'], b'x' * 100000)
+        self.assertEqual(self.db.large.count(), 50)
+
+    def test_write_batches(self):
+        self.assertGreater(self.db.max_write_batch_size, 0)
+        self.db.batches.drop()
+        self.db.max_write_batch_size = 10
+        self.assertEqual(self.db.batches.insert([{'_id': i} for i in range(25)]), 25)
+        self.assertEqual(len(self.db.batches.insertMany([{'n': i} for i in range(25)])), 25)
+        self.assertEqual(self.db.batches.count(), 50)
+        raw = nmongo.RawDocument(nmongo.bson_encode({'_id': 'raw', 'data': b'x' * 100000}))
+        self.assertEqual(self.db.batches.insert([raw] + [{'n': i} for i in range(15)]), 16)
+        self.assertEqual(len(self.db.batches.findOne({'_id': 'raw'})['data']), 100000)
+
+        r = nmongo._merge_write_replies(
+            {'ok': 1.0, 'n': 10},
+            {'ok': 1.0, 'n': 4, 'writeErrors': [{'index': 4, 'code': 11000}], 'writeConcernError': {'code': 64}},
+            10,
+        )
+        r = nmongo._merge_write_replies(r, {'ok': 0.0, 'errmsg': 'failed', 'code': 2}, 20)
+        self.assertEqual(r['n'], 14)
+        self.assertEqual(r['writeErrors'], [{'index': 14, 'code': 11000}])
+        self.assertEqual(r['writeConcernError'], {'code': 64})
+        self.assertEqual((r['ok'], r['errmsg']), (0.0, 'failed'))
+
+    def test_client_pool(self):
+        try:
+            import threading
+        except ImportError:
+            self.skipTest('threading is not available')
+        client = nmongo.MongoClient(
+            self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            ssl_ca_certs=self.ssl_ca_certs,
+            max_pool_size=3,
+            wait_queue_timeout=30,
+        )
+        try:
+            db = client[self.database]
+            counts = []
+
+            def count():
+                for _ in range(5):
+                    counts.append(db.pets.count())
+            threads = [threading.Thread(target=count) for _ in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(counts, [3] * 30)
+            stats = client.pool_stats()
+            self.assertLessEqual(stats['created'], 3)
+            self.assertEqual(stats['in_use'], 0)
+        finally:
+            client.close()
+
+    def test_parallel_find(self):
+        client = nmongo.MongoClient(
+            self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            ssl_ca_certs=self.ssl_ca_certs,
+            max_pool_size=4,
+        )
+        try:
+            db = client[self.database]
+            db.numbers.drop()
+            db.numbers.insert([{'n': n} for n in range(1000)])
+            docs = list(db.numbers.parallel_find(partitions=4, batchSize=100))
+            self.assertEqual(sorted(d['n'] for d in docs), list(range(1000)))
+            cursors = db.numbers.parallel_find({'n': {'$gte': 100}}, partitions=3, key='n', merge=False)
+            self.assertEqual(sum(len(c.fetchall()) for c in cursors), 900)
+            self.assertEqual(len(list(db.pets.parallel_find({'species': 'cat'}))), 2)
+            db.numbers.drop()
+        finally:
+            client.close()
+
+    def test_multiplexed_client(self):
+        try:
+            import threading
+        except ImportError:
+            self.skipTest('threading is not available')
+        client = nmongo.MultiplexedClient(
+            self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            ssl_ca_certs=self.ssl_ca_certs,
+        )
+        try:
+            db = client[self.database]
+            counts = []
+
+            def count():
+                for _ in range(5):
+                    counts.append(db.pets.count())
+            threads = [threading.Thread(target=count) for _ in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(counts, [3] * 30)
+            self.assertEqual(client.pool_stats()['created'], 1)
+        finally:
+            client.close()
+
+    def test_replica_set_client(self):
+        client = nmongo.ReplicaSetClient(
+            ['%s:%d' % (self.host, self.port)],
+            user=self.user,
+            password=self.password,
+            ssl_ca_certs=self.ssl_ca_certs,
+            read_preference='secondaryPreferred',
+        )
+        try:
+            db = client[self.database]
+            self.assertEqual(db.pets.count(), 3)
+            self.assertEqual(len(db.pets.find().fetchall()), 3)
+            self.assertEqual(len(client.get_database(self.database, 'primary').pets.find().fetchall()), 3)
+            types = [server['type'] for server in client.topology().values()]
+            self.assertTrue('primary' in types or 'standalone' in types)
+        finally:
+            client.close()
+
+    def test_replica_set_routing(self):
+        # members answer hello from a table instead of the network
+        hosts = ['a.test:27017', 'b.test:27017', 'c.test:27017']
+        rtts = {'a.test': 0.001, 'b.test': 0.05, 'c.test': 0.002}
+        hellos = {}
+
+        def elect(primary):
+            for host in hosts:
+                name = host.split(':')[0]
+                hellos[name] = {
+                    'ok': 1.0, 'setName': 'rs0', 'hosts': hosts,
+                    'isWritablePrimary': name == primary, 'secondary': name != primary,
+                }
+
+        class FakeReplicaSetClient(nmongo.ReplicaSetClient):
+            def _check(self, server):
+                with self._cond:
+                    r = hellos.get(server.host)
+                    if r is None:
+                        server.kind = 'unknown'
+                        server.rtt = None
+                    elif (server.host, server.port) in self._servers:
+                        self._learned = True
+                        self._update(server, r, rtts[server.host])
+
+        elect('a.test')
+        client = FakeReplicaSetClient(['a.test'], read_preference='secondaryPreferred', local_threshold=0.015)
+        try:
+            self.assertEqual(
+                client.topology(),
+                {
+                    'a.test:27017': {'type': 'primary', 'rtt': 0.001},
+                    'b.test:27017': {'type': 'secondary', 'rtt': 0.05},
+                    'c.test:27017': {'type': 'secondary', 'rtt': 0.002},
+                },
+            )
+
+            def route(metadata, read_preference=None):
+                pool, metadata = client._select(metadata, read_preference)
+                return pool.host, metadata.get('$readPreference', {}).get('mode')
+
+            # b is not within local_threshold of c
+            self.assertEqual(route({'find': 'pets'}), ('c.test', 'secondaryPreferred'))
+            self.assertEqual(route({'insert': 'pets'}), ('a.test', None))
+            self.assertEqual(route({'find': 'pets'}, 'primary'), ('a.test', None))
+            self.assertEqual(
+                set(route({'count': 'pets'}, 'nearest') for _ in range(50)),
+                set([('a.test', 'nearest'), ('c.test', 'nearest')]),
+            )
+            self.assertEqual(route({'aggregate': 'pets', 'pipeline': [{'$out': 'x'}]}), ('a.test', None))
+
+            # a steps down and b is elected, the monitor finds out when it is asked for a check
+            elect('b.test')
+            client._request_check()
+            if client._monitor is None:
+                client._check_all()
+            deadline = nmongo._monotonic() + 5
+            while client.topology()['b.test:27017']['type'] != 'primary' and nmongo._monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(route({'insert': 'pets'}), ('b.test', None))
+            self.assertEqual(route({'find': 'pets'}, 'primary'), ('b.test', None))
+            self.assertEqual(client.topology()['a.test:27017']['type'], 'secondary')
+
+            # with no secondary left, secondaryPreferred reads from the primary
+            del hellos['a.test']
+            del hellos['c.test']
+            client._check_all()
+            self.assertEqual(route({'find': 'pets'}), ('b.test', 'secondaryPreferred'))
+        finally:
+            client.close()
+
+    def test_fork(self):
+        if not hasattr(os, 'fork'):
+            self.skipTest('fork is not available')
+        oid = self.db.client.genObjectId()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child_oid = self.db.client.genObjectId()
+                ok = self.db.pets.count() == 3 and child_oid.oid[7:9] != oid.oid[7:9]
+            except Exception:
+                ok = False
+            os.write(w, b'1' if ok else b'0')
+            os._exit(0)
+        os.close(w)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(r, 1), b'1')
+        os.close(r)
+        self.assertEqual(self.db.pets.count(), 3)
+
+    def test_aio(self):
+        if sys.implementation.name == 'micropython':
+            # uasyncio streams have no writelines() or at_eof()
+            self.skipTest('asyncio streams are not available')
+        import asyncio
+        from nmongo.aio import connect
+
+        async def run():
+            db = await connect(
+                self.host,
+                self.database,
+                port=self.port,
+                user=self.user,
+                password=self.password,
+                ssl_ca_certs=self.ssl_ca_certs,
+            )
+            try:
+                await db.aio_items.drop()
+                ids = await db.aio_items.insertMany([{'i': i} for i in range(30)])
+                self.assertEqual(len(ids), 30)
+                counts = await asyncio.gather(*[db.aio_items.count({'i': i}) for i in range(10)])
+                self.assertEqual(counts, [1] * 10)
+                cursor = await db.aio_items.find({}, batchSize=7)
+                found = []
+                async for d in cursor:
+                    found.append(d['i'])
+                self.assertEqual(sorted(found), list(range(30)))
+                self.assertEqual((await db.aio_items.findOne({'i': 3}))['i'], 3)
+                find = db.aio_items.prepare_find(batchSize=4)
+                self.assertEqual(len(await (await find({'i': {'$lt': 10}})).fetchall()), 10)
+                async with db.pipeline() as p:
+                    count = p.aio_items.count()
+                    p.aio_items.insertOne({'i': 30})
+                self.assertEqual(count.value, 30)
+                found = []
+                async for d in await db.aio_items.parallel_find(partitions=3, key='i', batchSize=5):
+                    found.append(d['i'])
+                self.assertEqual(sorted(found), list(range(31)))
+                await db.aio_items.drop()
+            finally:
+                db.close()
+        asyncio.run(run())
+
     def test_decimal(self):
         datum = [
             [100, (0, (1, 0, 0), 0), '100'],